@@ -1,15 +1,25 @@
-import time
-from typing import Optional
-from fastapi import APIRouter, HTTPException, File, UploadFile, Form
+from typing import Dict, Optional, Tuple
+from fastapi import APIRouter, HTTPException, Request
 from pydantic import BaseModel
-from ..core.metrics import track_request_metrics, CHAT_REQUESTS
-from ..dependencies import ChatServiceDependency
-from ..exceptions import SessionNotFoundError, RateLimitError
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import MultipartParser, parse_options_header
+from ..core.metrics import track_request_metrics, CHAT_REQUESTS_ERROR
+from ..core import metrics_buffer
+from ..dependencies import ChatServiceDependency, AsyncDatabaseDependency
+from ..exceptions import (
+    RateLimitError,
+    ProviderRateLimitError, ProviderAuthError,
+    UNAUTHORIZED_ERROR, MESSAGE_PROCESSING_FAILED_ERROR, stamp_error
+)
 import structlog
 
 logger = structlog.get_logger()
 router = APIRouter(prefix="/images", tags=["images"])
 
+# Same limits Starlette's form parser (Form()) applies: text fields are buffered in memory
+MAX_FIELD_SIZE = 1024 * 1024  # bytes per non-file part
+MAX_PARTS = 1000
+
 
 class ImageMessageResponse(BaseModel):
     id: str
@@ -18,13 +28,124 @@ class ImageMessageResponse(BaseModel):
     created_at: str
     image_filename: Optional[str] = None
 
-@router.post("/sessions/{session_id}/messages", response_model=ImageMessageResponse)
+def _safe_decode(data: bytes) -> str:
+    """Decode a form value as UTF-8, falling back to latin-1 (never fails) like Starlette"""
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return data.decode("latin-1")
+
+async def _read_form_discarding_files(request: Request) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Stream-parse a multipart body keeping text fields and only the filename of file parts.
+    
+    File contents are dropped as they arrive instead of being spooled like UploadFile.
+    Text fields over MAX_FIELD_SIZE, or more than MAX_PARTS parts, are rejected with 413;
+    a malformed body with 400.
+    Returns (fields, filenames), both keyed by form field name.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type"))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=422, detail="Expected multipart/form-data body")
+    
+    fields: Dict[str, str] = {}
+    filenames: Dict[str, str] = {}
+    headers: Dict[bytes, bytes] = {}
+    header_field = bytearray()
+    header_value = bytearray()
+    part_name: Optional[str] = None
+    part_is_file = False
+    part_data = bytearray()
+    part_count = 0
+    
+    def on_part_begin() -> None:
+        nonlocal part_name, part_is_file, part_count
+        part_count += 1
+        if part_count > MAX_PARTS:
+            raise HTTPException(status_code=413, detail=f"Too many form parts (max {MAX_PARTS})")
+        headers.clear()
+        part_data.clear()
+        part_name, part_is_file = None, False
+    
+    def on_header_field(data: bytes, start: int, end: int) -> None:
+        header_field.extend(data[start:end])
+    
+    def on_header_value(data: bytes, start: int, end: int) -> None:
+        header_value.extend(data[start:end])
+    
+    def on_header_end() -> None:
+        headers[bytes(header_field).lower()] = bytes(header_value)
+        header_field.clear()
+        header_value.clear()
+    
+    def on_headers_finished() -> None:
+        nonlocal part_name, part_is_file
+        _, options = parse_options_header(headers.get(b"content-disposition"))
+        name = options.get(b"name")
+        part_name = _safe_decode(name) if name is not None else None
+        filename = options.get(b"filename")
+        if filename is not None:
+            part_is_file = True
+            if part_name is not None:
+                filenames[part_name] = _safe_decode(filename)
+    
+    def on_part_data(data: bytes, start: int, end: int) -> None:
+        if not part_is_file:
+            if len(part_data) + (end - start) > MAX_FIELD_SIZE:
+                raise HTTPException(status_code=413, detail=f"Form field too large (max {MAX_FIELD_SIZE} bytes)")
+            part_data.extend(data[start:end])
+    
+    def on_part_end() -> None:
+        if not part_is_file and part_name is not None:
+            fields[part_name] = _safe_decode(part_data)
+    
+    parser = MultipartParser(boundary, callbacks={
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+        parser.finalize()
+    except MultipartParseError as e:
+        raise HTTPException(status_code=400, detail=f"Malformed multipart body: {e}")
+    
+    return fields, filenames
+
+
+@router.post(
+    "/sessions/{session_id}/messages",
+    response_model=ImageMessageResponse,
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "required": ["message", "image"],
+                        "properties": {
+                            "message": {"type": "string"},
+                            "image": {"type": "string", "format": "binary"}
+                        }
+                    }
+                }
+            }
+        }
+    }
+)
 @track_request_metrics
 async def send_image_message_to_session(
     session_id: str,
+    request: Request,
     chat_service: ChatServiceDependency,
-    message: str = Form(...),
-    image: UploadFile = File(...)
+    db: AsyncDatabaseDependency
 ):
     """
     Send a text message to a chat session (image filename is logged but not processed).
@@ -35,28 +156,33 @@ async def send_image_message_to_session(
     
     Returns a MessageResponse with AI response to the text message only.
     """
+    fields, filenames = await _read_form_discarding_files(request)
+    message = fields.get("message")
+    image_filename = filenames.get("image")
+    if message is None or image_filename is None:
+        raise HTTPException(status_code=422, detail="Form fields 'message' and 'image' are required")
+    
     try:
         # Send only text message to AI service
         result = await chat_service.send_text_message(
+            db,
             session_id=session_id,
             message=message,
-            image_filename=image.filename,
+            image_filename=image_filename,
             max_tokens=1000,
             temperature=0.7,
             use_cache=True
         )
         
-        # Update metrics
-        CHAT_REQUESTS.labels(status="success").inc()
-        
         logger.info(
             "Text message with image reference processed",
             session_id=session_id,
-            image_filename=image.filename,
+            image_filename=image_filename,
             message_length=len(message)
         )
         
-        return ImageMessageResponse(
+        # Trusted internal data, skip re-validation
+        return ImageMessageResponse.model_construct(
             id=result["id"],
             content=result["content"],
             role=result["role"],
@@ -64,34 +190,26 @@ async def send_image_message_to_session(
             image_filename=result.get("image_filename")
         )
         
+    except HTTPException:
+        raise  # Re-raise HTTP exceptions (incl. SessionNotFoundError) as-is
+    
     except ValueError as e:
-        if "not found" in str(e):
-            raise SessionNotFoundError(session_id)
         raise HTTPException(status_code=400, detail=str(e))
-    
-    except HTTPException:
-        raise  # Re-raise HTTP exceptions as-is
         
     except Exception as e:
-        CHAT_REQUESTS.labels(status="error").inc()
-        logger.error("Message request failed", error=str(e), session_id=session_id)
+        metrics_buffer.bump(CHAT_REQUESTS_ERROR)
+        logger.exception("Message request failed", session_id=session_id)
         
         # Check for specific error types
-        if "rate limit" in str(e).lower() or "quota" in str(e).lower():
+        if isinstance(e, ProviderRateLimitError):
             raise RateLimitError()
-        elif "api key" in str(e).lower() or "unauthorized" in str(e).lower():
+        elif isinstance(e, ProviderAuthError):
             raise HTTPException(
                 status_code=401,
-                detail={
-                    "error": {"code": "UNAUTHORIZED", "message": "API authentication failed. Please check server configuration."},
-                    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-                }
+                detail=stamp_error(UNAUTHORIZED_ERROR)
             )
         else:
             raise HTTPException(
                 status_code=500,
-                detail={
-                    "error": {"code": "MESSAGE_PROCESSING_FAILED", "message": "Failed to process message. Please try again."},
-                    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-                }
+                detail=stamp_error(MESSAGE_PROCESSING_FAILED_ERROR)
             )
\ No newline at end of file
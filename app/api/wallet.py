@@ -1,16 +1,21 @@
 """Unified Wallet API for all payment and balance operations."""
 
-from datetime import datetime
+import asyncio
+import hashlib
+from datetime import datetime, timezone
 from typing import List, Optional
-from fastapi import APIRouter, HTTPException, Depends, Query, Request, BackgroundTasks
+from fastapi import APIRouter, HTTPException, Depends, Query, Request
+from fastapi.responses import ORJSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
+import asyncpg
+import orjson
 from pydantic import BaseModel
 
-from ..core.database import get_db
+from ..core.database import get_db, get_raw_db, AsyncSessionLocal
 from ..services.balance_service import BalanceService
 from ..services.payment_service import PaymentService
 from ..models.balance import (
-    BalanceResponse, TransactionHistoryResponse, AddBalanceRequest
+    BalanceResponse, TransactionHistoryResponse, AddBalanceRequest, to_amount
 )
 from ..models.payment import (
     CreateOrderResponse, VPAValidationRequest, VPAValidationResponse,
@@ -27,17 +32,28 @@ balance_service = BalanceService()
 payment_service = PaymentService()
 
 
+# Events are stored (processed_webhook_events) before they are acknowledged; the queue
+# only carries their ids to the workers, so anything it loses is found by the sweep
+WEBHOOK_WORKER_COUNT = 4
+WEBHOOK_SWEEP_INTERVAL = 30  # seconds
+WEBHOOK_DRAIN_TIMEOUT = 10  # seconds the workers get on shutdown to finish queued events
+webhook_queue: "asyncio.Queue[str]" = asyncio.Queue(maxsize=10_000)
+_webhook_workers: List[asyncio.Task] = []
+_webhook_sweeper_task: Optional[asyncio.Task] = None
+
+
 @router.get("/health")
 async def wallet_health():
     """Wallet service health check."""
     try:
         logger.info("Wallet health check requested")
-        return {
+        # Returned directly so orjson serializes the datetime (skips jsonable_encoder)
+        return ORJSONResponse({
             "status": "healthy",
             "service": "wallet",
             "webhook_endpoint": "https://api.disutopia.xyz/api/v1/wallet/webhook",
-            "timestamp": datetime.now().isoformat()
-        }
+            "timestamp": datetime.now(timezone.utc)
+        })
     except Exception as e:
         logger.error("Wallet health check failed", error=str(e))
         return {
@@ -59,23 +75,25 @@ class WalletResponse(BaseModel):
 async def get_wallet(
     user_id: str,
     include_transactions: int = Query(5, ge=0, le=20, description="Number of recent transactions to include"),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_db),
+    conn: asyncpg.Connection = Depends(get_raw_db)
 ):
     """Get user wallet with balance and recent transactions."""
     try:
         logger.info("Wallet request", user_id=user_id)
         
-        # Get balance
-        balance_info = await balance_service.get_user_balance(user_id, db)
-        
-        # Get recent transactions if requested
-        recent_transactions = []
+        # Balance (ORM session) and transactions (raw connection) run concurrently
         if include_transactions > 0:
-            recent_transactions = await balance_service.get_transaction_history(
-                user_id, db, limit=include_transactions
+            balance_info, recent_transactions = await asyncio.gather(
+                balance_service.get_user_balance(user_id, db),
+                balance_service.get_transaction_history(user_id, conn, limit=include_transactions)
             )
+        else:
+            balance_info = await balance_service.get_user_balance(user_id, db)
+            recent_transactions = []
         
-        return WalletResponse(
+        # Trusted internal data, skip re-validation
+        return WalletResponse.model_construct(
             user_id=balance_info.user_id,
             balance=balance_info.balance,
             last_updated=balance_info.last_updated,
@@ -95,12 +113,12 @@ async def get_transactions(
     user_id: str,
     limit: int = Query(50, ge=1, le=100),
     offset: int = Query(0, ge=0),
-    db: AsyncSession = Depends(get_db)
+    conn: asyncpg.Connection = Depends(get_raw_db)
 ):
     """Get full transaction history for a user."""
     try:
         logger.info("Transaction history request", user_id=user_id, limit=limit, offset=offset)
-        result = await balance_service.get_transaction_history(user_id, db, limit, offset)
+        result = await balance_service.get_transaction_history(user_id, conn, limit, offset)
         return result
     except Exception as e:
         logger.error("Transaction history failed", user_id=user_id, error=str(e))
@@ -157,68 +175,152 @@ async def add_money(
         )
 
 
-@router.post("/webhook")
-async def payment_webhook(
-    request: Request,
-    background_tasks: BackgroundTasks,
-    db: AsyncSession = Depends(get_db)
-):
-    """Handle Razorpay payment webhooks for wallet credits."""
-    try:
-        # Get raw payload for signature verification
-        raw_body = await request.body()
-        
-        # Get signature header
-        signature = request.headers.get("X-Razorpay-Signature", "")
-        event_id = request.headers.get("X-Razorpay-Event-Id", "")
-        
-        # Parse JSON data
-        webhook_data = await request.json()
-        logger.info(
-            "Wallet webhook received", 
-            webhook_event=webhook_data.get("event"),
-            event_id=event_id
+@router.post("/webhook", status_code=202)
+async def payment_webhook(request: Request, db: AsyncSession = Depends(get_db)):
+    """Handle Razorpay payment webhooks for wallet credits.
+    
+    The event is stored before the 202 (Razorpay does not redeliver after a 2xx);
+    failures to store it answer 5xx so Razorpay retries.
+    """
+    # Get raw payload for signature verification
+    raw_body = await request.body()
+    
+    # Get signature header
+    signature = request.headers.get("X-Razorpay-Signature", "")
+    event_id = request.headers.get("X-Razorpay-Event-Id", "")
+    
+    # Verify webhook signature (before parsing, so forged bodies cost only the HMAC)
+    is_valid = payment_service.verify_webhook_signature(raw_body, signature)
+    
+    if not is_valid:
+        logger.warning("Invalid webhook signature", event_id=event_id)
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid webhook signature"
         )
-        
-        # Verify webhook signature
-        is_valid = await payment_service.verify_webhook_signature(
-            raw_body.decode('utf-8'), 
-            signature
+    
+    # Parse JSON data from the already-read body
+    try:
+        webhook_data = orjson.loads(raw_body)
+    except orjson.JSONDecodeError:
+        webhook_data = None
+    if not isinstance(webhook_data, dict):
+        logger.warning("Malformed webhook body", event_id=event_id)
+        raise HTTPException(
+            status_code=400,
+            detail="Malformed webhook body"
         )
-        
-        if not is_valid:
-            logger.warning("Invalid webhook signature", event_id=event_id)
-            raise HTTPException(
-                status_code=400,
-                detail="Invalid webhook signature"
-            )
-        
-        # Check for duplicate event (idempotency)
-        is_duplicate = await payment_service.check_duplicate_event(event_id, db)
-        if is_duplicate:
-            logger.info("Duplicate webhook event, skipping", event_id=event_id)
-            return {"status": "duplicate_event_skipped"}
-        
-        # Process webhook in background
-        background_tasks.add_task(
-            _process_wallet_webhook, 
-            webhook_data,
-            event_id, 
-            db
+    
+    # Events without an id are keyed by their body, so a redelivery is still a duplicate
+    event_id = event_id or hashlib.sha256(raw_body).hexdigest()
+    logger.info(
+        "Wallet webhook received", 
+        webhook_event=webhook_data.get("event"),
+        event_id=event_id
+    )
+    
+    try:
+        is_new = await payment_service.record_webhook_event(event_id, webhook_data, db)
+        await db.commit()
+    except Exception as e:
+        logger.error("Failed to store webhook event", error=str(e), event_id=event_id)
+        raise HTTPException(
+            status_code=503,
+            detail="Webhook could not be stored, retry later"
         )
+    
+    if not is_new:
+        logger.info("Duplicate webhook event, skipping", event_id=event_id)
+        return {"status": "duplicate"}
+    
+    # Hand off to the webhook workers; if the queue is full the sweep picks the event up
+    try:
+        webhook_queue.put_nowait(event_id)
+    except asyncio.QueueFull:
+        logger.warning("Webhook queue full, leaving event to the sweep", event_id=event_id)
+    
+    # Accepted for asynchronous processing
+    return {"status": "webhook_accepted"}
+
+
+async def _webhook_worker():
+    """Consume queued webhook event ids, each event on its own short-lived DB session."""
+    while True:
+        event_id = await webhook_queue.get()
+        try:
+            await _run_webhook_event(event_id)
+        except Exception as e:
+            logger.error("Webhook worker error", error=str(e), event_id=event_id)
+        finally:
+            webhook_queue.task_done()
+
+
+async def _run_webhook_event(event_id: str):
+    """Claim a stored event, process it, and record the outcome (failures go back to pending)."""
+    async with AsyncSessionLocal() as db:
+        webhook_data = await payment_service.claim_webhook_event(event_id, db)
+        await db.commit()
+        if webhook_data is None:
+            return  # already processed, or another worker holds it
         
-        # Return success immediately
-        return {"status": "webhook_accepted"}
+        try:
+            succeeded = await _process_wallet_webhook(webhook_data, event_id, db)
+        except Exception as e:
+            logger.error("Webhook processing error", error=str(e), event_id=event_id)
+            succeeded = False
+        if not succeeded:
+            await db.rollback()
         
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error("Wallet webhook error", error=str(e))
-        return {"status": "error_logged", "error": str(e)}
+        await payment_service.finish_webhook_event(event_id, succeeded, db)
+        await db.commit()
+
+
+async def _webhook_sweeper():
+    """Re-queue stored events no worker finished (queue overflow, failed attempts, restarts)."""
+    while True:
+        try:
+            async with AsyncSessionLocal() as db:
+                event_ids = await payment_service.unfinished_webhook_events(db)
+            for event_id in event_ids:
+                webhook_queue.put_nowait(event_id)
+        except asyncio.QueueFull:
+            pass  # the rest are found by the next sweep
+        except Exception as e:
+            logger.error("Webhook sweep error", error=str(e))
+        await asyncio.sleep(WEBHOOK_SWEEP_INTERVAL)
+
 
+def start_webhook_workers():
+    """Spawn the webhook consumer tasks and the recovery sweep (called on app startup)."""
+    global _webhook_sweeper_task
+    for _ in range(WEBHOOK_WORKER_COUNT):
+        _webhook_workers.append(asyncio.create_task(_webhook_worker()))
+    _webhook_sweeper_task = asyncio.create_task(_webhook_sweeper())
 
-async def _process_wallet_webhook(webhook_data: dict, event_id: str, db: AsyncSession):
-    """Process wallet-specific webhook events."""
+
+async def stop_webhook_workers():
+    """Let the workers finish queued events, then cancel them (called on app shutdown).
+    
+    Whatever is still queued after WEBHOOK_DRAIN_TIMEOUT stays pending in the database
+    and is picked up by the sweep after the restart.
+    """
+    global _webhook_sweeper_task
+    if _webhook_sweeper_task is not None:
+        _webhook_sweeper_task.cancel()
+        await asyncio.gather(_webhook_sweeper_task, return_exceptions=True)
+        _webhook_sweeper_task = None
+    try:
+        await asyncio.wait_for(webhook_queue.join(), WEBHOOK_DRAIN_TIMEOUT)
+    except TimeoutError:
+        logger.warning("Webhook queue not drained before shutdown", remaining=webhook_queue.qsize())
+    for task in _webhook_workers:
+        task.cancel()
+    await asyncio.gather(*_webhook_workers, return_exceptions=True)
+    _webhook_workers.clear()
+
+
+async def _process_wallet_webhook(webhook_data: dict, event_id: str, db: AsyncSession) -> bool:
+    """Process wallet-specific webhook events; False if the event should be retried."""
     try:
         event = webhook_data.get("event")
         
@@ -233,8 +335,7 @@ async def _process_wallet_webhook(webhook_data: dict, event_id: str, db: AsyncSe
             
             # Get order details from Razorpay
             try:
-                order_details = payment_service.razorpay_client.order.fetch(order_id)
-                order_notes = order_details.get("notes", {})
+                order_notes = await payment_service.fetch_order_notes(order_id)
                 payment_type = order_notes.get("payment_type")
                 user_id = order_notes.get("user_id")
                 
@@ -244,16 +345,20 @@ async def _process_wallet_webhook(webhook_data: dict, event_id: str, db: AsyncSe
                     user_id=user_id,
                     amount=amount)
                 
-                # Credit balance for wallet top-ups
+                # Credit balance for wallet top-ups (once: a retried event may have credited already)
                 if payment_type == "balance_topup" and user_id and amount > 0:
-                    success = await balance_service.credit_balance(
-                        user_id=user_id,
-                        amount=amount,
-                        description=f"Wallet top-up via payment {payment_id}",
-                        reference_id=payment_id,
-                        reference_type="payment",
-                        db=db
-                    )
+                    if await balance_service.has_credit(user_id, payment_id, db):
+                        logger.info("Wallet top-up already credited", user_id=user_id, payment_id=payment_id)
+                        success = True
+                    else:
+                        success = await balance_service.credit_balance(
+                            user_id=user_id,
+                            amount=to_amount(amount),
+                            description=f"Wallet top-up via payment {payment_id}",
+                            reference_id=payment_id,
+                            reference_type="payment",
+                            db=db
+                        )
                     
                     if success:
                         logger.info("Wallet balance credited", 
@@ -268,12 +373,14 @@ async def _process_wallet_webhook(webhook_data: dict, event_id: str, db: AsyncSe
                 
             except Exception as e:
                 logger.warning("Could not process wallet credit", order_id=order_id, error=str(e))
+                return False
         
         # Process the main webhook through payment service
-        await payment_service.process_webhook(webhook_data, event_id, db)
+        return await payment_service.process_webhook(webhook_data, event_id, db)
         
     except Exception as e:
         logger.error("Wallet webhook processing error", error=str(e), event_id=event_id)
+        return False
 
 
 # UPI Payment endpoints for peer-to-peer payments
@@ -381,7 +488,7 @@ async def verify_and_credit_payment(
         if payment_type == "balance_topup" and noted_user_id == user_id and amount > 0:
             success = await balance_service.credit_balance(
                 user_id=user_id,
-                amount=amount,
+                amount=to_amount(amount),
                 description=f"Wallet top-up via verified payment {payment_id}",
                 reference_id=payment_id,
                 reference_type="payment",
@@ -1,111 +1,332 @@
-import json
-import hashlib
+import asyncio
 import zlib
-from typing import Optional, Any, Dict, List
-import redis
+from decimal import Decimal
+from typing import Optional, Any, Dict, List, Tuple
+from cachetools import TLRUCache
+import orjson
+from redis.asyncio import Redis, ConnectionPool
+import xxhash
+import zstandard
 from .config import settings
 import structlog
 
 logger = structlog.get_logger()
 
 # Redis connection with connection pooling
-redis_client = redis.ConnectionPool.from_url(
+redis_client = ConnectionPool.from_url(
     settings.REDIS_URL, 
-    decode_responses=True,
-    max_connections=20,
+    decode_responses=False,  # Values are (possibly compressed) bytes
+    max_connections=50,
     retry_on_timeout=True
 )
-redis_conn = redis.Redis(connection_pool=redis_client)
+redis_conn = Redis(connection_pool=redis_client)
+
+# Shared zstd contexts (level 3 is the library default speed/ratio tradeoff)
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+_CCTX = zstandard.ZstdCompressor(level=3)
+_DCTX = zstandard.ZstdDecompressor()
+
+# Process-local L1 in front of Redis for hot repeat questions (decompressed values).
+# Entries are (value, seconds to keep) and never outlive their Redis copy.
+L1_TTL = 300
+_L1 = TLRUCache(maxsize=10_000, ttu=lambda _key, entry, now: now + entry[1])
+
+
+def _l1_set(key: str, value: str, ttl: float) -> None:
+    if ttl > 0:
+        _L1[key] = (value, min(ttl, L1_TTL))
+
+# Strong references to in-flight background response writes (the loop only keeps weak ones)
+_pending_writes: set = set()
+
+# Fill the history list only if its generation is unchanged since the reader looked
+# (KEYS: list, generation; ARGV: generation read or "", ttl, items...)
+_FILL_HISTORY_LUA = """
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then return 0 end
+redis.call('DEL', KEYS[1])
+redis.call('RPUSH', KEYS[1], unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# Appends one turn, but only onto the list get_history returned (KEYS[2] unchanged since then);
+# otherwise drops the list. Either way the generation moves on, so older fills are rejected.
+# KEYS: history list, generation. ARGV: expected generation, ttl, items...
+_APPEND_HISTORY_LUA = """
+local current = (redis.call('GET', KEYS[2]) or '') == ARGV[1] and redis.call('EXISTS', KEYS[1]) == 1
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+if not current then
+    redis.call('DEL', KEYS[1])
+    return 0
+end
+redis.call('RPUSH', KEYS[1], unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# User balances are written through on debit and dropped on credit; the TTL only bounds drift
+BALANCE_TTL = 60
 
 class CacheService:
     def __init__(self):
         self.client = redis_conn
         self.default_ttl = settings.CACHE_TTL
         self.compression_threshold = 1024  # Compress responses > 1KB
-    
-    def _generate_key(self, prefix: str, data: dict) -> str:
-        """Generate a consistent cache key using SHA-256"""
-        data_str = json.dumps(data, sort_keys=True, separators=(',', ':'))
-        hash_obj = hashlib.sha256(data_str.encode('utf-8'))
-        return f"chat_cache:{prefix}:{hash_obj.hexdigest()[:16]}"
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._fill_history = self.client.register_script(_FILL_HISTORY_LUA)
+        self._append_history = self.client.register_script(_APPEND_HISTORY_LUA)
     
     def _get_conversation_key(self, messages: List[Dict[str, str]]) -> str:
-        """Generate cache key from user's current question only"""
-        if not messages:
-            return self._generate_key("simple", {"question": ""})
-            
-        # Get the last user message (current question)
-        current_user_msg = messages[-1] if messages else {}
+        """Generate cache key from user's current question only
         
-        # Cache based ONLY on the user's current message content
-        # This ensures identical questions always hit cache regardless of conversation history
-        if current_user_msg.get("role") == "user":
-            user_question = current_user_msg.get("content", "").strip().lower()
-            cache_data = {"question": user_question}
+        Identical questions hit the cache regardless of conversation history. The normalized
+        question is hashed directly with xxh3-64 (non-cryptographic, no JSON canonicalization).
+        """
+        last = messages[-1] if messages else {}
+        content = last.get("content", "")
+        if last.get("role") == "user" and isinstance(content, str):
+            question = content.strip().lower()
         else:
-            # Fallback for unexpected message structure
-            cache_data = {"question": str(current_user_msg)}
-            
-        return self._generate_key("simple", cache_data)
+            # Unexpected message structure (or no messages): key on the whole last message
+            question = str(last) if last else ""
+        return f"chat_cache:simple:{xxhash.xxh3_64_hexdigest(question.encode('utf-8'))}"
     
     def _compress_data(self, data: str) -> bytes:
         """Compress data if it's large enough"""
         if len(data) > self.compression_threshold:
-            return zlib.compress(data.encode('utf-8'))
+            return _CCTX.compress(data.encode('utf-8'))
         return data.encode('utf-8')
     
     def _decompress_data(self, data: bytes) -> str:
         """Decompress data if needed"""
+        if data.startswith(_ZSTD_MAGIC):
+            return _DCTX.decompress(data).decode('utf-8')
         try:
-            # Try to decompress first
+            # Legacy zlib payloads written before the zstd switch
             return zlib.decompress(data).decode('utf-8')
         except (zlib.error, UnicodeDecodeError):
             # If decompression fails, assume it's uncompressed
             return data.decode('utf-8')
     
-    def get_chat_response(self, messages: List[Dict[str, str]]) -> Optional[str]:
-        """Get cached chat response"""
+    async def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        """Fetch several raw cache values in a single round trip"""
+        return await self.client.mget(keys)
+    
+    async def _get_many_with_ttl(self, keys: List[str]) -> List[Tuple[Optional[bytes], int]]:
+        """Fetch several raw cache values with their remaining TTL (ms) in a single round trip"""
+        async with self.client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.get(key)
+                pipe.pttl(key)
+            results = await pipe.execute()
+        return list(zip(results[::2], results[1::2]))
+    
+    async def _batched_get(self, key: str) -> Tuple[Optional[bytes], int]:
+        """Queue a lookup to be resolved by the next batched round trip"""
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[key] = future
+            if self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._flush_pending())
+        return await asyncio.shield(future)
+    
+    async def _flush_pending(self) -> None:
+        """Resolve queued lookups, one round trip per batch.
+        
+        Lookups made while a batch is in flight go out together in the next one, so a
+        lookup only waits when another is already pending; an uncontended one is sent
+        on the next loop iteration.
+        """
+        try:
+            await asyncio.sleep(0)  # take in lookups queued in the same loop iteration
+            while self._pending:
+                pending, self._pending = self._pending, {}
+                keys = list(pending)
+                try:
+                    values = await self._get_many_with_ttl(keys)
+                except Exception as e:
+                    for future in pending.values():
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for key, value in zip(keys, values):
+                    if not pending[key].done():
+                        pending[key].set_result(value)
+        finally:
+            self._flush_task = None
+    
+    async def get_chat_response(self, messages: List[Dict[str, str]]) -> Tuple[str, Optional[str]]:
+        """Get cached chat response, returning (key, response) so a miss can be stored without rehashing"""
+        key = self._get_conversation_key(messages)
+        local_entry = _L1.get(key)
+        if local_entry is not None:
+            return key, local_entry[0]
+        
         try:
-            key = self._get_conversation_key(messages)
-            cached_data = self.client.get(key)
+            cached_data, pttl = await self._batched_get(key)
             
             if cached_data:
-                logger.info("Cache hit", question=messages[-1].get("content", "")[:50] if messages else "")
+                logger.debug("Cache hit", question=messages[-1].get("content", "")[:50] if messages else "")
                 
-                # Handle both compressed and uncompressed data
-                if isinstance(cached_data, bytes):
-                    return self._decompress_data(cached_data)
-                return cached_data
+                value = self._decompress_data(cached_data)
+                # Only for what is left of the Redis TTL (-1: key has no expiry)
+                _l1_set(key, value, pttl / 1000 if pttl >= 0 else L1_TTL)
+                return key, value
             else:
-                logger.info("Cache miss", question=messages[-1].get("content", "")[:50] if messages else "")
-                return None
+                logger.debug("Cache miss", question=messages[-1].get("content", "")[:50] if messages else "")
+                return key, None
                 
         except Exception as e:
             logger.error("Cache get error", error=str(e))
-            return None
+            return key, None
     
-    def set_chat_response(self, messages: List[Dict[str, str]], response: str, ttl: Optional[int] = None) -> bool:
+    async def set_chat_response(self, messages: List[Dict[str, str]], response: str, ttl: Optional[int] = None) -> bool:
         """Cache chat response with compression"""
+        return await self.set_chat_response_by_key(self._get_conversation_key(messages), response, ttl)
+    
+    async def set_chat_response_by_key(self, key: str, response: str, ttl: Optional[int] = None) -> bool:
+        """Cache chat response under a key previously returned by get_chat_response"""
         try:
-            key = self._get_conversation_key(messages)
             ttl = ttl or self.default_ttl
+            _l1_set(key, response, ttl)
             
             # Compress large responses
             compressed_response = self._compress_data(response)
-            success = self.client.setex(key, ttl, compressed_response)
+            success = await self.client.setex(key, ttl, compressed_response)
             
-            logger.debug("Response cached", question=messages[-1].get("content", "")[:50] if messages else "")
+            logger.debug("Response cached", key=key)
             return success
             
         except Exception as e:
             logger.error("Cache set error", error=str(e))
             return False
     
+    def store_chat_response(self, key: str, response: Optional[str], ttl: Optional[int] = None) -> None:
+        """Cache a fresh completion without waiting on Redis (L1 is filled immediately).
+        
+        Empty replies (e.g. tool-call scaffolds with no text) are not worth serving again and are skipped.
+        """
+        if not response or response.isspace():
+            return
+        ttl = ttl or self.default_ttl
+        _l1_set(key, response, ttl)
+        task = asyncio.create_task(self.set_chat_response_by_key(key, response, ttl))
+        _pending_writes.add(task)
+        task.add_done_callback(_pending_writes.discard)
+    
+    async def get_json(self, key: str) -> Optional[Any]:
+        """Get a JSON value stored with set_json"""
+        try:
+            data = await self.client.get(key)
+            return orjson.loads(data) if data else None
+        except Exception as e:
+            logger.error("Cache get error", key=key, error=str(e))
+            return None
+    
+    async def set_json(self, key: str, value: Any, ttl: Optional[int] = None) -> bool:
+        """Cache a JSON-serializable value"""
+        try:
+            return await self.client.setex(key, ttl or self.default_ttl, orjson.dumps(value))
+        except Exception as e:
+            logger.error("Cache set error", key=key, error=str(e))
+            return False
+    
+    @staticmethod
+    def _history_key(session_id: str) -> str:
+        return f"chat_history:{session_id}"
+    
+    @staticmethod
+    def _history_gen_key(session_id: str) -> str:
+        return f"chat_history_gen:{session_id}"
+    
+    async def get_history(self, session_id: str) -> Tuple[Optional[List[Dict[str, str]]], Optional[bytes]]:
+        """Get the cached [{role, content}] history for a session (None on miss or Redis error),
+        plus the generation to pass to set_history when refilling it after a miss"""
+        try:
+            async with self.client.pipeline(transaction=False) as pipe:
+                pipe.lrange(self._history_key(session_id), 0, -1)
+                pipe.get(self._history_gen_key(session_id))
+                items, generation = await pipe.execute()
+            return ([orjson.loads(item) for item in items] if items else None), generation
+        except Exception as e:
+            logger.error("Cache get error", session_id=session_id, error=str(e))
+            return None, None
+    
+    async def set_history(self, session_id: str, messages: List[Dict[str, str]], generation: Optional[bytes]) -> None:
+        """Fill the cached history from a DB read, unless it was invalidated since get_history
+        returned generation (the read may predate that write, so it would be stale)"""
+        if not messages:
+            return
+        try:
+            await self._fill_history(
+                keys=[self._history_key(session_id), self._history_gen_key(session_id)],
+                args=[generation or b"", self.default_ttl, *[orjson.dumps(m) for m in messages]]
+            )
+        except Exception as e:
+            logger.error("Cache set error", session_id=session_id, error=str(e))
+    
+    async def append_history(
+        self, session_id: str, messages: List[Dict[str, str]], generation: Optional[bytes]
+    ) -> bool:
+        """Append a new turn ahead of the DB commit, onto the history get_history returned
+        with generation. If anything was written since, the cached list is dropped instead
+        (it may lack a concurrent turn) and False is returned, as on a Redis error."""
+        try:
+            return bool(await self._append_history(
+                keys=[self._history_key(session_id), self._history_gen_key(session_id)],
+                args=[generation or b"", self.default_ttl, *[orjson.dumps(m) for m in messages]]
+            ))
+        except Exception as e:
+            logger.error("Cache set error", session_id=session_id, error=str(e))
+            return False
+    
+    async def invalidate_history(self, session_id: str) -> None:
+        """Drop the cached history after a write; the next read refills it from the DB"""
+        gen_key = self._history_gen_key(session_id)
+        try:
+            async with self.client.pipeline(transaction=True) as pipe:
+                pipe.incr(gen_key)
+                pipe.expire(gen_key, self.default_ttl)
+                pipe.delete(self._history_key(session_id))
+                await pipe.execute()
+        except Exception as e:
+            logger.error("Cache delete error", session_id=session_id, error=str(e))
+    
+    @staticmethod
+    def _balance_key(user_id: str) -> str:
+        return f"balance:{user_id}"
+    
+    async def get_balance(self, user_id: str) -> Optional[Decimal]:
+        """Get a cached user balance (None on miss or Redis error)"""
+        try:
+            data = await self.client.get(self._balance_key(user_id))
+            return Decimal(data.decode()) if data is not None else None
+        except Exception as e:
+            logger.error("Cache get error", user_id=user_id, error=str(e))
+            return None
+    
+    async def set_balance(self, user_id: str, balance: Decimal, ttl: int = BALANCE_TTL, only_if_missing: bool = False) -> bool:
+        """Cache a user balance; only_if_missing (SET NX) keeps a fill from a DB read
+        from overwriting a newer write-through value"""
+        try:
+            return bool(await self.client.set(self._balance_key(user_id), str(balance), ex=ttl, nx=only_if_missing))
+        except Exception as e:
+            logger.error("Cache set error", user_id=user_id, error=str(e))
+            return False
+    
+    async def invalidate_balance(self, user_id: str) -> None:
+        try:
+            await self.client.delete(self._balance_key(user_id))
+        except Exception as e:
+            logger.error("Cache delete error", user_id=user_id, error=str(e))
     
-    def health_check(self) -> Dict[str, Any]:
+    async def health_check(self) -> Dict[str, Any]:
         """Simple health check"""
         try:
-            ping_result = self.client.ping()
+            ping_result = await self.client.ping()
             return {
                 "status": "healthy" if ping_result else "unhealthy",
                 "connection": ping_result
@@ -1,4 +1,5 @@
 import os
+from typing import Optional
 from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings
 
@@ -53,12 +54,23 @@ class Settings(BaseSettings):
     
     # Logging
     LOG_LEVEL: str = Field(default="INFO")
+    LOG_HTTP_REQUESTS: bool = Field(default=True)  # per-request start/complete log lines
+    
+    # Metrics
+    METRICS_ENABLED: bool = Field(default=True)  # False skips chat handler timing/counters
     
     # Razorpay Payment Gateway - REQUIRED: Set in environment variables  
     RAZORPAY_KEY_ID: str = Field(description="Razorpay Key ID - MUST be set via environment variable")
     RAZORPAY_KEY_SECRET: str = Field(description="Razorpay Key Secret - MUST be set via environment variable") 
     RAZORPAY_WEBHOOK_SECRET: str = Field(description="Razorpay Webhook Secret - MUST be set via environment variable")
     
+    # Worker threads for blocking SDK calls (asyncio.to_thread); sized for concurrent Razorpay requests
+    BLOCKING_IO_THREADS: int = Field(default=64)
+    
+    # Snowflake worker id (0-1023). Only for single-process deployments; unset, each
+    # process leases a distinct id from Redis at startup
+    SNOWFLAKE_WORKER_ID: Optional[int] = Field(default=None, ge=0, le=1023)
+    
     
     model_config = {
         "env_file": ".env",
@@ -0,0 +1,52 @@
+"""
+Time-ordered 64-bit IDs (Snowflake layout)
+41 bits of milliseconds since EPOCH_MS | 10 bits of worker id | 12 bits of sequence
+"""
+import time
+from typing import Optional
+
+from .config import settings
+
+EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+
+# Shared counter every process leases its worker id from
+WORKER_ID_KEY = "snowflake:worker_seq"
+
+# Set once per process by init_worker_id() (pids repeat across containers, so they can't be used)
+_WORKER_ID: Optional[int] = None
+
+# [last millisecond, sequence]; only touched from the event loop thread
+_STATE = [0, 0]
+
+async def init_worker_id(redis) -> int:
+    """Assign this process's worker id (called on app startup)
+    
+    SNOWFLAKE_WORKER_ID pins it; otherwise the next value of a Redis counter shared by all
+    replicas and workers is taken, so live processes don't share one. Redis errors propagate:
+    IDs must not be handed out without a worker id.
+    """
+    global _WORKER_ID
+    if settings.SNOWFLAKE_WORKER_ID is not None:
+        _WORKER_ID = settings.SNOWFLAKE_WORKER_ID
+    else:
+        _WORKER_ID = await redis.incr(WORKER_ID_KEY) & 0x3FF
+    return _WORKER_ID
+
+def snowflake_id() -> int:
+    """Next k-sortable ID for this process"""
+    if _WORKER_ID is None:
+        raise RuntimeError("snowflake_id() called before init_worker_id()")
+    now = int(time.time() * 1000) - EPOCH_MS
+    last, seq = _STATE
+    if now <= last:
+        # Same millisecond (or clock stepped back): keep counting on the last timestamp
+        now = last
+        seq = (seq + 1) & 0xFFF
+        if seq == 0:
+            # 4096 IDs this millisecond; move on to the next one
+            now = last + 1
+    else:
+        seq = 0
+    _STATE[0] = now
+    _STATE[1] = seq
+    return (now << 22) | (_WORKER_ID << 12) | seq
@@ -1,31 +1,32 @@
 import structlog
 import logging
 import sys
+import orjson
 from .config import settings
 
 def setup_logging():
-    # Configure structlog
+    log_level = getattr(logging, settings.LOG_LEVEL)
+
+    # Configure structlog (bypasses the stdlib handler chain; filtered calls are no-ops)
     structlog.configure(
         processors=[
-            structlog.stdlib.filter_by_level,
-            structlog.stdlib.add_logger_name,
-            structlog.stdlib.add_log_level,
-            structlog.stdlib.PositionalArgumentsFormatter(),
+            structlog.processors.add_log_level,
             structlog.processors.TimeStamper(fmt="iso"),
             structlog.processors.StackInfoRenderer(),
             structlog.processors.format_exc_info,
-            structlog.processors.JSONRenderer() if not settings.DEBUG 
+            structlog.processors.JSONRenderer(serializer=orjson.dumps) if not settings.DEBUG
             else structlog.dev.ConsoleRenderer()
         ],
         context_class=dict,
-        logger_factory=structlog.stdlib.LoggerFactory(),
-        wrapper_class=structlog.stdlib.BoundLogger,
+        logger_factory=structlog.BytesLoggerFactory() if not settings.DEBUG
+        else structlog.PrintLoggerFactory(),
+        wrapper_class=structlog.make_filtering_bound_logger(log_level),
         cache_logger_on_first_use=True,
     )
-    
-    # Configure standard library logging
+
+    # Configure standard library logging for third-party libraries
     logging.basicConfig(
         format="%(message)s",
         stream=sys.stdout,
-        level=getattr(logging, settings.LOG_LEVEL),
-    )
\ No newline at end of file
+        level=log_level,
+    )
@@ -1,10 +1,23 @@
-from prometheus_client import Counter, Histogram, Gauge, generate_latest
+from prometheus_client import Counter, Histogram, Gauge, generate_latest, disable_created_metrics
 import time
 from functools import wraps
+from starlette.responses import StreamingResponse
+
+from . import metrics_buffer
+from .config import settings
+
+# Skip the per-series *_created samples (smaller scrapes)
+disable_created_metrics()
 
 # Metrics
-REQUEST_COUNT = Counter('http_requests_total', 'Total HTTP requests', ['method', 'endpoint', 'status'])
-REQUEST_DURATION = Histogram('http_request_duration_seconds', 'HTTP request duration', ['method', 'endpoint'])
+# Generic http_* metrics come from prometheus-fastapi-instrumentator (see app.main);
+# these cover only the chat handlers wrapped with track_request_metrics.
+REQUEST_COUNT = Counter('chat_http_requests_total', 'Total chat HTTP requests', ['method', 'endpoint', 'status'])
+# Chat latency is seconds-scale (LLM round trips), so sub-10ms buckets are dropped
+REQUEST_DURATION = Histogram(
+    'chat_http_request_duration_seconds', 'Chat HTTP request duration', ['method', 'endpoint'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
 ACTIVE_CONNECTIONS = Gauge('active_connections', 'Active connections')
 CHAT_REQUESTS = Counter('chat_requests_total', 'Total chat requests', ['status'])
 CACHE_HITS = Counter('cache_hits_total', 'Cache hits', ['type'])
@@ -12,22 +25,35 @@ CACHE_MISSES = Counter('cache_misses_total', 'Cache misses', ['type'])
 CACHE_ERRORS = Counter('cache_errors_total', 'Cache errors', ['type'])
 TOKENS_USED = Counter('tokens_used_total', 'Total tokens used')
 
+# Pre-bound children for constant label sets (skips .labels() lookups per request)
+_REQ_SUCCESS = REQUEST_COUNT.labels(method="POST", endpoint="/chat", status="success")
+_REQ_ERROR = REQUEST_COUNT.labels(method="POST", endpoint="/chat", status="error")
+_REQ_DURATION = REQUEST_DURATION.labels(method="POST", endpoint="/chat")
+CHAT_REQUESTS_SUCCESS = CHAT_REQUESTS.labels(status="success")
+CHAT_REQUESTS_ERROR = CHAT_REQUESTS.labels(status="error")
+
 def track_request_metrics(func):
     """Decorator to track request metrics"""
+    if not settings.METRICS_ENABLED:
+        return func
+    
     @wraps(func)
     async def wrapper(*args, **kwargs):
-        start_time = time.time()
+        start_time = time.perf_counter()
         try:
             result = await func(*args, **kwargs)
-            REQUEST_COUNT.labels(method="POST", endpoint="/chat", status="success").inc()
-            return result
         except Exception as e:
-            REQUEST_COUNT.labels(method="POST", endpoint="/chat", status="error").inc()
+            metrics_buffer.bump(_REQ_ERROR)
+            _REQ_DURATION.observe(time.perf_counter() - start_time)
             raise
-        finally:
-            REQUEST_DURATION.labels(method="POST", endpoint="/chat").observe(time.time() - start_time)
+        # A streamed body hasn't run yet; its outcome is counted where it is streamed
+        if not isinstance(result, StreamingResponse):
+            metrics_buffer.bump(_REQ_SUCCESS)
+            _REQ_DURATION.observe(time.perf_counter() - start_time)
+        return result
     return wrapper
 
 def get_metrics():
     """Get Prometheus metrics"""
+    metrics_buffer.flush()  # don't make scrapes wait for the next periodic flush
     return generate_latest()
\ No newline at end of file
@@ -0,0 +1,54 @@
+"""
+Batched counter increments
+Hot paths bump an in-process dict; a background task applies the totals to
+Prometheus periodically, so the client's per-sample lock is taken once per
+flush instead of once per request. Scrapes may lag by up to FLUSH_INTERVAL.
+"""
+import asyncio
+from typing import Dict, Optional
+
+import structlog
+
+logger = structlog.get_logger()
+
+FLUSH_INTERVAL = 0.1  # seconds
+
+# Keyed by pre-bound Counter children (see app.core.metrics)
+_CTRS: Dict[object, int] = {}
+_flush_task: Optional[asyncio.Task] = None
+
+def bump(counter, amount: int = 1) -> None:
+    """Record an increment for counter; applied on the next flush"""
+    _CTRS[counter] = _CTRS.get(counter, 0) + amount
+
+def flush() -> None:
+    """Apply buffered increments to their counters"""
+    if not _CTRS:
+        return
+    pending = list(_CTRS.items())
+    _CTRS.clear()
+    for counter, count in pending:
+        counter.inc(count)
+
+async def flush_loop() -> None:
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception as e:
+            logger.error("Metrics flush failed", error=str(e))
+
+def start_flush_loop() -> None:
+    global _flush_task
+    _flush_task = asyncio.create_task(flush_loop())
+
+async def stop_flush_loop() -> None:
+    global _flush_task
+    if _flush_task is not None:
+        _flush_task.cancel()
+        try:
+            await _flush_task
+        except asyncio.CancelledError:
+            pass
+        _flush_task = None
+    flush()
@@ -25,6 +25,20 @@ AVAILABLE_PROVIDERS = [
     ] if settings.LM_STUDIO_ENABLED else [])
 ]
 
+# Ordered list above is kept for listings; the set gives O(1) membership checks
+_AVAILABLE_PROVIDERS_SET = frozenset(AVAILABLE_PROVIDERS)
+
+# Lookup tables built once from settings (fixed for the process lifetime)
+_OPENROUTER_DEFAULT = ("openrouter", settings.DEFAULT_MODEL)
+_BACKEND_ONLY: Dict[str, Tuple[str, str]] = {
+    "openrouter": _OPENROUTER_DEFAULT,
+    "lm_studio": ("lm_studio", settings.LM_STUDIO_DEFAULT_MODEL),
+}
+_DEFAULT_TUPLE = _BACKEND_ONLY["lm_studio"] if settings.DEFAULT_LLM_BACKEND == "lm_studio" else _OPENROUTER_DEFAULT
+_PROVIDER_MAP: Dict[str, Tuple[str, str]] = {
+    provider: tuple(provider.split("/", 1)) for provider in AVAILABLE_PROVIDERS
+}
+
 def parse_provider(provider: Optional[str] = None) -> Tuple[str, Optional[str]]:
     """
     Parse provider string into (backend, model)
@@ -38,46 +52,36 @@ def parse_provider(provider: Optional[str] = None) -> Tuple[str, Optional[str]]:
     """
     if not provider:
         # Use default backend with its default model
-        backend = settings.DEFAULT_LLM_BACKEND
-        if backend == "lm_studio":
-            model = settings.LM_STUDIO_DEFAULT_MODEL
-        else:
-            backend = "openrouter"
-            model = settings.DEFAULT_MODEL
-        return backend, model
+        return _DEFAULT_TUPLE
+    
+    known = _PROVIDER_MAP.get(provider)
+    if known is not None:
+        return known
     
     if "/" not in provider:
-        # Just backend specified, use default model
-        backend = provider
-        if backend == "lm_studio":
-            model = settings.LM_STUDIO_DEFAULT_MODEL
-        elif backend == "openrouter":
-            model = settings.DEFAULT_MODEL
-        else:
-            backend = "openrouter"
-            model = settings.DEFAULT_MODEL
-        return backend, model
+        # Just backend specified, use default model (unknown backends fall back to OpenRouter)
+        return _BACKEND_ONLY.get(provider, _OPENROUTER_DEFAULT)
     
     # Full provider/model specified
     backend, model = provider.split("/", 1)
     return backend, model
 
+# Providers grouped by backend and the full listing, computed once at import
+_PROVIDERS_BY_BACKEND: Dict[str, List[str]] = {}
+for _provider in AVAILABLE_PROVIDERS:
+    _backend, _model = _provider.split("/", 1)
+    _PROVIDERS_BY_BACKEND.setdefault(_backend, []).append(_model)
+
+_PROVIDERS_RESPONSE = {
+    "available_providers": AVAILABLE_PROVIDERS,
+    "providers_by_backend": _PROVIDERS_BY_BACKEND,
+    "default_provider": f"{settings.DEFAULT_LLM_BACKEND}/{settings.LM_STUDIO_DEFAULT_MODEL if settings.DEFAULT_LLM_BACKEND == 'lm_studio' else settings.DEFAULT_MODEL}"
+}
+
 def get_available_providers() -> Dict:
     """Get all available providers in a simple format"""
-    providers_by_backend = {}
-    
-    for provider in AVAILABLE_PROVIDERS:
-        backend, model = provider.split("/", 1)
-        if backend not in providers_by_backend:
-            providers_by_backend[backend] = []
-        providers_by_backend[backend].append(model)
-    
-    return {
-        "available_providers": AVAILABLE_PROVIDERS,
-        "providers_by_backend": providers_by_backend,
-        "default_provider": f"{settings.DEFAULT_LLM_BACKEND}/{settings.LM_STUDIO_DEFAULT_MODEL if settings.DEFAULT_LLM_BACKEND == 'lm_studio' else settings.DEFAULT_MODEL}"
-    }
+    return _PROVIDERS_RESPONSE
 
 def validate_provider(provider: str) -> bool:
     """Check if a provider is available"""
-    return provider in AVAILABLE_PROVIDERS
\ No newline at end of file
+    return provider in _AVAILABLE_PROVIDERS_SET
\ No newline at end of file
@@ -0,0 +1,16 @@
+"""
+Cached UTC timestamp formatting
+strftime runs at most once per wall-clock second
+"""
+import time
+
+# [second, formatted]; a race between requests at most returns the previous second
+_TS_CACHE = [0, ""]
+
+def utc_timestamp() -> str:
+    """Current UTC time as ISO 8601 with second precision (e.g. 2025-01-01T00:00:00Z)"""
+    now = int(time.time())
+    if now != _TS_CACHE[0]:
+        _TS_CACHE[1] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now))
+        _TS_CACHE[0] = now
+    return _TS_CACHE[1]
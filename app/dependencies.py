@@ -1,19 +1,25 @@
 from typing import Annotated
-from fastapi import Depends
+import asyncpg
+from fastapi import Depends, Request
 from sqlalchemy.ext.asyncio import AsyncSession
 from .services.chat_service import ChatService
-from .core.database import get_db
+from .core.database import get_db, get_raw_db
 from .core.cache import cache
 from .services.openrouter_service import openrouter_service
 from .services.lm_studio import lm_studio_service
 from .core.config import settings
 
-def get_chat_service(db: AsyncSession = Depends(get_db)) -> ChatService:
-    """Create chat service with dependencies"""
+def create_chat_service() -> ChatService:
+    """Build the process-wide chat service (called once from the app lifespan)"""
     # Include LM Studio service only if enabled
     lm_studio = lm_studio_service if settings.LM_STUDIO_ENABLED else None
-    return ChatService(db, cache, openrouter_service, lm_studio)
+    return ChatService(cache, openrouter_service, lm_studio)
+
+def get_chat_service(request: Request) -> ChatService:
+    """Return the lifespan-scoped chat service singleton"""
+    return request.app.state.chat_service
 
 # Type aliases for cleaner code
 ChatServiceDependency = Annotated[ChatService, Depends(get_chat_service)]
-AsyncDatabaseDependency = Annotated[AsyncSession, Depends(get_db)]
\ No newline at end of file
+AsyncDatabaseDependency = Annotated[AsyncSession, Depends(get_db)]
+RawDatabaseDependency = Annotated[asyncpg.Connection, Depends(get_raw_db)]
\ No newline at end of file
@@ -1,7 +1,8 @@
+import re
 from fastapi import HTTPException
 from enum import Enum
-from datetime import datetime
 from typing import Optional
+from .core.timestamps import utc_timestamp
 
 class ErrorCode(str, Enum):
     SESSION_NOT_FOUND = "SESSION_NOT_FOUND"
@@ -11,6 +12,51 @@ class ErrorCode(str, Enum):
     SESSION_CREATION_FAILED = "SESSION_CREATION_FAILED"
     UNAUTHORIZED = "UNAUTHORIZED"
 
+# Static parts of common error payloads, built once at import time
+UNAUTHORIZED_ERROR = {"error": {"code": "UNAUTHORIZED", "message": "API authentication failed. Please check server configuration."}}
+MESSAGE_PROCESSING_FAILED_ERROR = {"error": {"code": "MESSAGE_PROCESSING_FAILED", "message": "Failed to process message. Please try again."}}
+SESSION_CREATION_FAILED_ERROR = {"error": {"code": "SESSION_CREATION_FAILED", "message": "Failed to create session. Please try again."}}
+
+def make_error_detail(code: str, message: str, retry_after: Optional[int] = None) -> dict:
+    """Build an error payload of the shape {"error": {...}, "timestamp": ...}"""
+    error = {"code": code, "message": message}
+    if retry_after:
+        error["retry_after"] = retry_after
+    return {"error": error, "timestamp": utc_timestamp()}
+
+def stamp_error(template: dict) -> dict:
+    """Stamp the current timestamp onto one of the precomputed error payloads above"""
+    return {"error": template["error"], "timestamp": utc_timestamp()}
+
+# Keyword fallbacks for provider errors that don't carry a telling status code
+RATE_LIMIT_PATTERN = re.compile(r"rate limit|quota", re.IGNORECASE)
+AUTH_PATTERN = re.compile(r"api key|unauthorized", re.IGNORECASE)
+
+class ProviderError(Exception):
+    """LLM provider call failed
+    
+    kind is "api" (upstream HTTP error), "request" (transport failure) or "response" (unreadable reply).
+    """
+    def __init__(self, message: str, kind: str = "api", status_code: Optional[int] = None, body: Optional[str] = None):
+        super().__init__(message)
+        self.kind = kind
+        self.status_code = status_code
+        self.body = body
+
+class ProviderRateLimitError(ProviderError):
+    """LLM provider rejected the request due to rate limiting or quota"""
+
+class ProviderAuthError(ProviderError):
+    """LLM provider rejected the configured credentials"""
+
+def classify_provider_error(status_code: int, error_msg: str, body: Optional[str] = None) -> ProviderError:
+    """Map an upstream HTTP error to a typed exception (classified once, at the source)"""
+    if status_code == 429 or RATE_LIMIT_PATTERN.search(error_msg):
+        return ProviderRateLimitError(error_msg, status_code=status_code, body=body)
+    if status_code in (401, 403) or AUTH_PATTERN.search(error_msg):
+        return ProviderAuthError(error_msg, status_code=status_code, body=body)
+    return ProviderError(error_msg, status_code=status_code, body=body)
+
 class ChatAPIException(HTTPException):
     """Base exception for chat API errors"""
     
@@ -21,16 +67,8 @@ class ChatAPIException(HTTPException):
         status_code: int = 500, 
         retry_after: Optional[int] = None
     ):
-        detail = {
-            "error": {
-                "code": error_code.value,
-                "message": message,
-            },
-            "timestamp": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-        }
-        
-        if retry_after:
-            detail["error"]["retry_after"] = retry_after
+        # error_code is a str-Enum member, serializes as its value
+        detail = make_error_detail(error_code, message, retry_after)
             
         super().__init__(status_code=status_code, detail=detail)
 
@@ -1,53 +1,95 @@
 import asyncio
+import itertools
+import logging
 import os
+import secrets
 import sys
 import time
-import uuid
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional
 
 # Fix for Windows async event loop compatibility with psycopg
 # Only apply this fix when actually running on Windows (not in Docker containers)
 if sys.platform == "win32" and not os.getenv("CONTAINER_ENV"):
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 from fastapi import FastAPI, HTTPException, Depends, Request, Response
+import msgspec
+import orjson
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import PlainTextResponse, ORJSONResponse, StreamingResponse
+from prometheus_fastapi_instrumentator import Instrumentator
 from pydantic import BaseModel
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from .core.config import settings
-from .core.database import get_db, engine, Base, init_database, check_database_health
+from .core.database import (
+    get_db, engine, Base, init_database, check_database_health,
+    init_raw_pool, close_raw_pool
+)
 from .core.cache import cache
 from .core.logging import setup_logging
+from .core import metrics_buffer
+from .core.timestamps import utc_timestamp
+from .core.ids import init_worker_id
 from .core.metrics import (
     get_metrics, track_request_metrics, 
-    CHAT_REQUESTS, CACHE_HITS, TOKENS_USED
+    CHAT_REQUESTS_SUCCESS, CHAT_REQUESTS_ERROR, CACHE_HITS, TOKENS_USED
 )
 from .core.providers import parse_provider, get_available_providers, AVAILABLE_PROVIDERS
 from .models.chat import ChatSession
+from .services.lm_studio import lm_studio_service
+from .services.openrouter_service import openrouter_service
+from .services.usage_writer import start_usage_writer, stop_usage_writer
+from .services.chat_service import drain_background_tasks
 from .api.images import router as images_router
-from .api.wallet import router as wallet_router
-from .dependencies import ChatServiceDependency
-from .exceptions import SessionNotFoundError, RateLimitError, OpenRouterAPIError
+from .api.wallet import router as wallet_router, start_webhook_workers, stop_webhook_workers
+from .dependencies import ChatServiceDependency, AsyncDatabaseDependency, create_chat_service
+from .exceptions import (
+    SessionNotFoundError, RateLimitError, OpenRouterAPIError,
+    ProviderRateLimitError, ProviderAuthError,
+    UNAUTHORIZED_ERROR, MESSAGE_PROCESSING_FAILED_ERROR, SESSION_CREATION_FAILED_ERROR,
+    stamp_error
+)
 import structlog
 
 # Setup logging
 setup_logging()
 logger = structlog.get_logger()
 
-# Database tables will be created on startup
+# Initialize database and shared services for the app's lifetime
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # asyncio.to_thread runs on the default executor; the stock size (cpu + 4) backlogs webhook bursts
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=settings.BLOCKING_IO_THREADS)
+    )
+    await init_worker_id(cache.client)
+    await init_database()
+    await init_raw_pool()
+    app.state.chat_service = create_chat_service()
+    start_webhook_workers()
+    start_usage_writer()
+    metrics_buffer.start_flush_loop()
+    try:
+        yield
+    finally:
+        await metrics_buffer.stop_flush_loop()
+        await drain_background_tasks()
+        await stop_usage_writer()
+        await stop_webhook_workers()
+        await openrouter_service.aclose()
+        await lm_studio_service.aclose()
+        await close_raw_pool()
 
 app = FastAPI(
     title=settings.PROJECT_NAME,
     version=settings.API_VERSION,
-    debug=settings.DEBUG
+    debug=settings.DEBUG,
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
-# Initialize database on startup
-@app.on_event("startup")
-async def startup_event():
-    await init_database()
-
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -61,6 +103,14 @@ app.add_middleware(
 app.include_router(images_router, prefix="/api/v1")
 app.include_router(wallet_router, prefix="/api/v1")
 
+# Standard HTTP metrics for all routes (served by the existing /metrics endpoint)
+Instrumentator(
+    excluded_handlers=[r"/health", r"/metrics"],
+    should_group_status_codes=True,
+    should_instrument_requests_inprogress=True,
+    inprogress_labels=True
+).instrument(app)
+
 # Models
 class SessionRequest(BaseModel):
     pass
@@ -70,11 +120,38 @@ class SessionResponse(BaseModel):
     created_at: str
     expires_in: int
 
-class MessageRequest(BaseModel):
+class MessageRequest(msgspec.Struct):
     message: str
     stream: bool = False
     provider: Optional[str] = None  # "backend/model" format (e.g. "lm_studio/gemma-3-1b-it")
 
+async def parse_message_request(request: Request) -> MessageRequest:
+    """Decode and validate the message body with msgspec (C decoder, no Pydantic validator chain)"""
+    try:
+        return msgspec.json.decode(await request.body(), type=MessageRequest)
+    except (msgspec.ValidationError, msgspec.DecodeError) as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+# Body is parsed by parse_message_request, so describe it for OpenAPI explicitly
+MESSAGE_REQUEST_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "application/json": {
+                "schema": {
+                    "type": "object",
+                    "required": ["message"],
+                    "properties": {
+                        "message": {"type": "string"},
+                        "stream": {"type": "boolean", "default": False},
+                        "provider": {"anyOf": [{"type": "string"}, {"type": "null"}], "default": None}
+                    }
+                }
+            }
+        }
+    }
+}
+
 class MessageResponse(BaseModel):
     id: str
     content: str
@@ -101,13 +178,21 @@ class ErrorResponse(BaseModel):
     timestamp: str
 
 
+# Request IDs: random per-process prefix + counter (no getrandom syscall per request)
+_REQUEST_ID_PREFIX = secrets.token_hex(4)
+_request_counter = itertools.count()
+_LOG_REQUESTS = settings.LOG_HTTP_REQUESTS and getattr(logging, settings.LOG_LEVEL) <= logging.INFO
+
 # Middleware for request logging
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
-    start_time = time.time()
+    if not _LOG_REQUESTS:
+        return await call_next(request)
     
-    # Generate request ID
-    request_id = str(uuid.uuid4())
+    start_time = time.perf_counter()
+    
+    # Prefer the caller's request ID (e.g. set by nginx), otherwise generate one
+    request_id = request.headers.get("x-request-id") or f"{_REQUEST_ID_PREFIX}-{next(_request_counter)}"
     
     logger.info(
         "Request started",
@@ -119,7 +204,7 @@ async def log_requests(request: Request, call_next):
     
     response = await call_next(request)
     
-    process_time = time.time() - start_time
+    process_time = time.perf_counter() - start_time
     logger.info(
         "Request completed",
         request_id=request_id,
@@ -130,34 +215,65 @@ async def log_requests(request: Request, call_next):
     return response
 
 @app.post("/api/v1/sessions", response_model=SessionResponse)
-async def create_session(request: SessionRequest, chat_service: ChatServiceDependency):
+async def create_session(request: SessionRequest, chat_service: ChatServiceDependency, db: AsyncDatabaseDependency):
     try:
-        session = await chat_service.create_session()
-        created_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        session = await chat_service.create_session(db)
+        created_at = utc_timestamp()
         
         return SessionResponse(
             session_id=session.session_id,
             created_at=created_at,
             expires_in=3600  # 1 hour
         )
-    except Exception as e:
-        logger.error("Session creation failed", error=str(e))
+    except Exception:
+        logger.exception("Session creation failed")
         raise HTTPException(
             status_code=500,
-            detail={
-                "error": {"code": "SESSION_CREATION_FAILED", "message": "Failed to create session. Please try again."},
-                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-            }
+            detail=stamp_error(SESSION_CREATION_FAILED_ERROR)
         )
 
-@app.post("/api/v1/sessions/{session_id}/messages", response_model=MessageResponse)
+async def _sse_events(deltas: AsyncIterator[str], session_id: str) -> AsyncIterator[bytes]:
+    """Frame response text deltas as server-sent events"""
+    try:
+        async for delta in deltas:
+            yield b"data: " + orjson.dumps({"content": delta}) + b"\n\n"
+    except Exception:
+        # Status line is already sent; report the failure in-band
+        metrics_buffer.bump(CHAT_REQUESTS_ERROR)
+        logger.exception("Streamed message failed", session_id=session_id)
+        yield b"data: " + orjson.dumps(stamp_error(MESSAGE_PROCESSING_FAILED_ERROR)) + b"\n\n"
+    else:
+        # Counted once the stream has completed, so a failed stream is only an error
+        metrics_buffer.bump(CHAT_REQUESTS_SUCCESS)
+    yield b"data: [DONE]\n\n"
+
+@app.post("/api/v1/sessions/{session_id}/messages", response_model=MessageResponse, openapi_extra=MESSAGE_REQUEST_OPENAPI)
 @track_request_metrics
-async def send_message_to_session(session_id: str, request: MessageRequest, chat_service: ChatServiceDependency):
+async def send_message_to_session(
+    session_id: str,
+    chat_service: ChatServiceDependency,
+    db: AsyncDatabaseDependency,
+    request: MessageRequest = Depends(parse_message_request)
+):
     try:
         # Parse provider selection
         backend, model = parse_provider(request.provider)
         
+        if request.stream:
+            deltas = await chat_service.stream_message(
+                db,
+                session_id=session_id,
+                message=request.message,
+                max_tokens=1000,
+                temperature=0.7,
+                use_cache=True,
+                backend=backend,
+                model=model
+            )
+            return StreamingResponse(_sse_events(deltas, session_id), media_type="text/event-stream")
+        
         result = await chat_service.send_message(
+            db,
             session_id=session_id,
             message=request.message,
             max_tokens=1000,
@@ -168,51 +284,48 @@ async def send_message_to_session(session_id: str, request: MessageRequest, chat
         )
         
         # Update metrics
-        CHAT_REQUESTS.labels(status="success").inc()
+        metrics_buffer.bump(CHAT_REQUESTS_SUCCESS)
         
-        return MessageResponse(
-            id=result["id"],
-            content=result["content"],
-            role=result["role"],
-            created_at=result["created_at"]
-        )
+        # Serialized straight to orjson (MessageResponse documents the shape)
+        return ORJSONResponse({
+            "id": result["id"],
+            "content": result["content"],
+            "role": result["role"],
+            "created_at": result["created_at"],
+            "image_filename": None
+        })
+    
+    except SessionNotFoundError:
+        raise
     
     except ValueError as e:
-        if "not found" in str(e):
-            raise SessionNotFoundError(session_id)
         raise HTTPException(status_code=400, detail=str(e))
     
     except Exception as e:
-        CHAT_REQUESTS.labels(status="error").inc()
-        logger.error("Message request failed", error=str(e), session_id=session_id)
+        metrics_buffer.bump(CHAT_REQUESTS_ERROR)
+        logger.exception("Message request failed", session_id=session_id)
         
         # Check for specific error types
-        if "rate limit" in str(e).lower() or "quota" in str(e).lower():
+        if isinstance(e, ProviderRateLimitError):
             raise RateLimitError()
-        elif "api key" in str(e).lower() or "unauthorized" in str(e).lower():
+        elif isinstance(e, ProviderAuthError):
             raise HTTPException(
                 status_code=401,
-                detail={
-                    "error": {"code": "UNAUTHORIZED", "message": "API authentication failed. Please check server configuration."},
-                    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-                }
+                detail=stamp_error(UNAUTHORIZED_ERROR)
             )
         else:
             raise HTTPException(
                 status_code=500,
-                detail={
-                    "error": {"code": "MESSAGE_PROCESSING_FAILED", "message": "Failed to process message. Please try again."},
-                    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-                }
+                detail=stamp_error(MESSAGE_PROCESSING_FAILED_ERROR)
             )
 
 @app.get("/api/v1/health")
 async def health_check():
-    # Check database health
-    db_health = await check_database_health()
-    
-    # Check cache health
-    cache_health = cache.health_check()
+    # Database and cache checks are independent; run them concurrently
+    db_health, cache_health = await asyncio.gather(
+        check_database_health(),
+        cache.health_check()
+    )
     
     # Determine overall status
     overall_healthy = (
@@ -236,43 +349,34 @@ async def metrics():
 
 
 @app.get("/api/v1/sessions/{session_id}/messages", response_model=MessageHistoryResponse)
-async def get_session_messages(session_id: str, chat_service: ChatServiceDependency):
+async def get_session_messages(session_id: str, chat_service: ChatServiceDependency, db: AsyncDatabaseDependency):
     try:
-        messages = await chat_service.get_message_history(session_id)
+        messages = await chat_service.get_message_history(db, session_id)
         
-        message_items = [
-            MessageHistoryItem(
-                id=msg["id"],
-                role=msg["role"],
-                content=msg["content"],
-                created_at=msg["created_at"],
-                image_filename=msg.get("image_filename")
-            )
-            for msg in messages
-        ]
-        
-        return MessageHistoryResponse(
-            messages=message_items,
-            total_count=len(message_items)
-        )
+        # Service already returns MessageHistoryItem-shaped dicts; skip per-item validation
+        return ORJSONResponse({
+            "messages": messages,
+            "total_count": len(messages)
+        })
         
+    except SessionNotFoundError:
+        raise
+    
     except ValueError as e:
-        if "not found" in str(e):
-            raise SessionNotFoundError(session_id)
         raise HTTPException(status_code=400, detail=str(e))
     
-    except Exception as e:
-        logger.error("Failed to get session messages", error=str(e))
+    except Exception:
+        logger.exception("Failed to get session messages", session_id=session_id)
         raise HTTPException(status_code=500, detail="Failed to retrieve messages")
 
 @app.delete("/api/v1/sessions/{session_id}", response_model=DeleteSessionResponse)
-async def delete_session(session_id: str, chat_service: ChatServiceDependency):
+async def delete_session(session_id: str, chat_service: ChatServiceDependency, db: AsyncDatabaseDependency):
     try:
-        await chat_service.delete_session(session_id)
+        await chat_service.delete_session(db, session_id)
         return DeleteSessionResponse(message="Session deleted successfully")
     
-    except Exception as e:
-        logger.error("Failed to delete session", error=str(e), session_id=session_id)
+    except Exception:
+        logger.exception("Failed to delete session", session_id=session_id)
         raise HTTPException(status_code=500, detail="Failed to delete session")
 
 @app.get("/api/v1/backends")
@@ -298,10 +402,13 @@ async def get_available_backends():
         "default_backend": settings.DEFAULT_LLM_BACKEND
     }
 
+# Provider list is static for the process lifetime, so encode it once
+_PROVIDERS_BODY = orjson.dumps(get_available_providers())
+
 @app.get("/api/v1/providers")
 async def get_available_providers_simple():
     """Get available providers in simplified format"""
-    return get_available_providers()
+    return Response(content=_PROVIDERS_BODY, media_type="application/json")
 
 @app.get("/")
 async def root():
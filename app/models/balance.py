@@ -1,22 +1,32 @@
 """Balance models for user wallet system."""
 
 from datetime import datetime
+from decimal import Decimal
 from typing import Optional
-from sqlalchemy import Column, String, Float, DateTime, Text, Index
+from sqlalchemy import Column, String, Numeric, DateTime, Text, Index
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.sql import func
 from pydantic import BaseModel, validator
 
 from ..core.database import Base
 
+# Balances and amounts are stored as NUMERIC(18, 6)
+AMOUNT_QUANTUM = Decimal("0.000001")
+
+
+def to_amount(value) -> Decimal:
+    """Convert an API/gateway amount (float, int or str) to a quantized Decimal."""
+    return Decimal(str(value)).quantize(AMOUNT_QUANTUM)
+
 
 class UserBalance(Base):
     """Database model for user balance tracking."""
     __tablename__ = "user_balances"
 
     user_id = Column(String(255), primary_key=True, index=True)
-    balance = Column(Float, nullable=False, default=0.0)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    balance = Column(Numeric(18, 6), nullable=False, default=0)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
 
 class BalanceTransaction(Base):
@@ -26,15 +36,20 @@ class BalanceTransaction(Base):
     id = Column(String(50), primary_key=True)  # transaction_id
     user_id = Column(String(255), nullable=False, index=True)
     transaction_type = Column(String(20), nullable=False)  # credit, debit
-    amount = Column(Float, nullable=False)
+    amount = Column(Numeric(18, 6), nullable=False)
     description = Column(Text)
     reference_id = Column(String(100))  # payment_id or other reference
     reference_type = Column(String(50))  # payment, usage, adjustment
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
 
-    # Create composite index for user queries
+    # Newest-first history per user; INCLUDE carries the remaining selected columns
+    # so the history query is an index-only range scan
     __table_args__ = (
-        Index('idx_user_date', 'user_id', 'created_at'),
+        Index(
+            'ix_balance_transactions_user_created',
+            'user_id', created_at.desc(),
+            postgresql_include=['id', 'transaction_type', 'amount', 'description', 'reference_id', 'reference_type']
+        ),
     )
 
 
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, Float, JSON
+from sqlalchemy import Column, BigInteger, Integer, String, Text, DateTime, Float, JSON, Index, ForeignKey
 from sqlalchemy.sql import func
 from ..core.database import Base
 
@@ -14,8 +14,9 @@ class ChatSession(Base):
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
     
-    id = Column(Integer, primary_key=True, index=True)
-    session_id = Column(String(255), index=True)
+    # Snowflake id assigned by the app, so it can be returned before the row is written
+    id = Column(BigInteger, primary_key=True, index=True, autoincrement=False)
+    session_id = Column(String(255), ForeignKey("chat_sessions.session_id", ondelete="CASCADE"), index=True)
     role = Column(String(50))  # user, assistant
     content = Column(Text)
     image_url = Column(String(500), nullable=True)  # Filename reference for uploaded image
@@ -24,6 +25,11 @@ class ChatMessage(Base):
     model_used = Column(String(100), nullable=True)
     message_metadata = Column(JSON, nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    __table_args__ = (
+        # Serves the per-session history query in time order without a sort
+        Index('idx_session_created', 'session_id', 'created_at'),
+    )
 
 class ApiUsage(Base):
     __tablename__ = "api_usage"
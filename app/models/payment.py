@@ -1,21 +1,35 @@
 """Payment models for UPI transactions."""
 
 from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
 from typing import Optional
-from sqlalchemy import Column, String, Float, DateTime, Boolean, Text
+from sqlalchemy import Column, String, Float, DateTime, Boolean, Text, Index, text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.sql import func
 from pydantic import BaseModel, validator
 import re
 
 from ..core.database import Base
 
+# UPI VPA format (handle@provider), compiled once for the validators below
+UPI_VPA_PATTERN = re.compile(r'^[a-zA-Z0-9.\-_]{2,256}@[a-zA-Z0-9]{2,64}')
+
+
+def to_paise(amount) -> int:
+    """Convert a rupee amount (float, int, str or Decimal) to integer paise, rounding half up.
+    
+    Goes through Decimal(str(...)) so amounts like 0.07 or 1.15 don't lose a paisa to float error.
+    """
+    return int((Decimal(str(amount)) * 100).to_integral_value(rounding=ROUND_HALF_UP))
+
 
 class PaymentTransaction(Base):
     """Database model for payment transactions."""
     __tablename__ = "payment_transactions"
 
     tracking_id = Column(String(50), primary_key=True)
-    order_id = Column(String(100), nullable=False)
+    order_id = Column(String(100))  # Set once Razorpay creates the link's order (on payment)
     payment_link_id = Column(String(100), nullable=False)
     payment_link_url = Column(String(500))
     upi_intent_url = Column(String(1000))
@@ -27,9 +41,37 @@ class PaymentTransaction(Base):
     description = Column(Text)
     status = Column(String(50), default="created")  # created, authorized, captured, failed, refunded
     error_message = Column(Text)  # Store error details for failed payments
-    notes = Column(Text)  # JSON field for storing webhook event IDs and other metadata
-    created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    notes = Column(JSONB, default=dict, server_default=text("'{}'::jsonb"))  # Business metadata (webhook idempotency lives in processed_webhook_events)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        # Webhook handlers look payments up by Razorpay order id, or by payment link id
+        # for payment_link.paid (the only event that carries it)
+        Index('ix_payment_transactions_order_id', 'order_id'),
+        Index('ix_payment_transactions_payment_link_id', 'payment_link_id'),
+    )
+
+
+class ProcessedWebhookEvent(Base):
+    """Razorpay webhook events (X-Razorpay-Event-Id), stored before they are acknowledged.
+    
+    The primary key makes redeliveries no-ops; pending/processing rows are the durable
+    work queue the webhook workers drain (and pick up again after a restart).
+    """
+    __tablename__ = "processed_webhook_events"
+
+    event_id = Column(String(100), primary_key=True)
+    status = Column(String(20), nullable=False, server_default="processed")  # pending, processing, processed
+    payload = Column(JSONB)  # Event body, kept until processed
+    received_at = Column(DateTime(timezone=True), server_default=func.now())
+    claimed_at = Column(DateTime(timezone=True))  # Start of the current processing attempt
+    processed_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        # The recovery sweep only scans unfinished events
+        Index('ix_processed_webhook_events_unfinished', 'received_at', postgresql_where=text("status <> 'processed'")),
+    )
 
 
 # Pydantic models for API
@@ -40,8 +82,7 @@ class VPAValidationRequest(BaseModel):
     @validator('vpa')
     def validate_vpa_format(cls, v):
         """Validate UPI VPA format."""
-        upi_pattern = r'^[a-zA-Z0-9.\-_]{2,256}@[a-zA-Z0-9]{2,64}'
-        if not re.match(upi_pattern, v):
+        if '@' not in v or not UPI_VPA_PATTERN.match(v):
             raise ValueError('Invalid UPI VPA format')
         return v
 
@@ -74,8 +115,7 @@ class CollectRequest(BaseModel):
     @validator('payer_vpa', 'beneficiary_vpa')
     def validate_vpa_format(cls, v):
         """Validate UPI VPA format."""
-        upi_pattern = r'^[a-zA-Z0-9.\-_]{2,256}@[a-zA-Z0-9]{2,64}'
-        if not re.match(upi_pattern, v):
+        if '@' not in v or not UPI_VPA_PATTERN.match(v):
             raise ValueError('Invalid UPI VPA format')
         return v
 
@@ -95,7 +135,7 @@ class CollectResponse(BaseModel):
 class PaymentStatusResponse(BaseModel):
     """Response model for payment status."""
     tracking_id: str
-    order_id: str
+    order_id: Optional[str] = None
     payment_id: str
     status: str
     amount: float
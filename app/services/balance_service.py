@@ -1,12 +1,13 @@
 """Balance service for user wallet management."""
 
-import uuid
-from datetime import datetime
+from decimal import Decimal
 from typing import List, Optional
+import asyncpg
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, desc
-from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import select, update, func, text
 
+from ..core.cache import cache
+from ..core.ids import snowflake_id
 from ..models.balance import (
     UserBalance, BalanceTransaction,
     BalanceResponse, TransactionHistoryResponse
@@ -15,6 +16,43 @@ import structlog
 
 logger = structlog.get_logger()
 
+_TRANSACTION_HISTORY_SQL = """
+    SELECT id, transaction_type, amount, description, reference_id, reference_type, created_at
+    FROM balance_transactions
+    WHERE user_id = $1
+    ORDER BY created_at DESC
+    LIMIT $2 OFFSET $3
+"""
+
+_CREDIT_BALANCE_SQL = text("""
+    WITH up AS (
+        INSERT INTO user_balances (user_id, balance, created_at, updated_at)
+        VALUES (:user_id, :amount, now(), now())
+        ON CONFLICT (user_id) DO UPDATE
+            SET balance = user_balances.balance + EXCLUDED.balance, updated_at = now()
+        RETURNING user_id
+    )
+    INSERT INTO balance_transactions
+        (id, user_id, transaction_type, amount, description, reference_id, reference_type, created_at)
+    SELECT :tx_id, up.user_id, 'credit', CAST(:amount AS NUMERIC(18, 6)),
+           :description, :reference_id, :reference_type, now()
+    FROM up
+""")
+
+# Existing rows come from the SELECT branch; the INSERT branch returns a row only when it
+# created one, so reading a balance never writes to an existing row
+_GET_OR_CREATE_BALANCE_SQL = text("""
+    WITH ins AS (
+        INSERT INTO user_balances (user_id, balance, created_at, updated_at)
+        VALUES (:user_id, 0, now(), now())
+        ON CONFLICT (user_id) DO NOTHING
+        RETURNING user_id, balance, updated_at
+    )
+    SELECT user_id, balance, updated_at FROM ins
+    UNION ALL
+    SELECT user_id, balance, updated_at FROM user_balances WHERE user_id = :user_id
+""")
+
 
 class BalanceService:
     """Service class for handling user balance operations."""
@@ -24,28 +62,23 @@ class BalanceService:
         try:
             logger.info("Getting user balance", user_id=user_id)
             
-            # Get or create user balance
-            result = await db.execute(
-                select(UserBalance).where(UserBalance.user_id == user_id)
-            )
-            user_balance = result.scalar_one_or_none()
-            
-            if not user_balance:
-                # Create new balance record with 0.0 balance
-                user_balance = UserBalance(
-                    user_id=user_id,
-                    balance=0.0,
-                    created_at=datetime.utcnow(),
-                    updated_at=datetime.utcnow()
+            # Get or create user balance in one statement
+            result = await db.execute(_GET_OR_CREATE_BALANCE_SQL, {"user_id": user_id})
+            row = result.first()
+            await db.commit()
+            
+            if row is None:
+                # A concurrent request created the row after our snapshot was taken
+                result = await db.execute(
+                    select(UserBalance.user_id, UserBalance.balance, UserBalance.updated_at)
+                    .where(UserBalance.user_id == user_id)
                 )
-                db.add(user_balance)
-                await db.commit()
-                logger.info("Created new balance record", user_id=user_id)
+                row = result.one()
             
             return BalanceResponse(
-                user_id=user_balance.user_id,
-                balance=user_balance.balance,
-                last_updated=user_balance.updated_at
+                user_id=row.user_id,
+                balance=row.balance,
+                last_updated=row.updated_at
             )
             
         except Exception as e:
@@ -56,44 +89,42 @@ class BalanceService:
     async def get_transaction_history(
         self, 
         user_id: str, 
-        db: AsyncSession,
+        conn: asyncpg.Connection,
         limit: int = 50,
         offset: int = 0
     ) -> List[TransactionHistoryResponse]:
-        """Get transaction history for a user."""
+        """Get transaction history for a user (read-only, raw asyncpg)."""
         try:
             logger.info("Getting transaction history", user_id=user_id, limit=limit, offset=offset)
             
-            result = await db.execute(
-                select(BalanceTransaction)
-                .where(BalanceTransaction.user_id == user_id)
-                .order_by(desc(BalanceTransaction.created_at))
-                .limit(limit)
-                .offset(offset)
+            rows = await conn.fetch(
+                _TRANSACTION_HISTORY_SQL,
+                user_id, limit, offset
             )
-            transactions = result.scalars().all()
-            
-            return [
-                TransactionHistoryResponse(
-                    id=tx.id,
-                    transaction_type=tx.transaction_type,
-                    amount=tx.amount,
-                    description=tx.description,
-                    reference_id=tx.reference_id,
-                    reference_type=tx.reference_type,
-                    created_at=tx.created_at
-                )
-                for tx in transactions
-            ]
+            
+            return [TransactionHistoryResponse(**dict(row)) for row in rows]
             
         except Exception as e:
             logger.error("Error getting transaction history", user_id=user_id, error=str(e))
             raise
 
+    async def has_credit(self, user_id: str, reference_id: str, db: AsyncSession) -> bool:
+        """Whether a credit for this reference (e.g. payment id) was already recorded for the user."""
+        result = await db.execute(
+            select(BalanceTransaction.id)
+            .where(
+                BalanceTransaction.user_id == user_id,
+                BalanceTransaction.reference_id == reference_id,
+                BalanceTransaction.transaction_type == "credit"
+            )
+            .limit(1)
+        )
+        return result.scalar_one_or_none() is not None
+
     async def credit_balance(
         self,
         user_id: str,
-        amount: float,
+        amount: Decimal,
         description: str,
         reference_id: Optional[str] = None,
         reference_type: str = "payment",
@@ -104,38 +135,23 @@ class BalanceService:
             logger.info("Crediting balance", user_id=user_id, amount=amount, reference_id=reference_id)
             
             # Generate transaction ID
-            transaction_id = f"tx_{uuid.uuid4().hex[:12]}"
-            
-            # Get or create user balance using UPSERT
-            stmt = insert(UserBalance).values(
-                user_id=user_id,
-                balance=amount,
-                created_at=datetime.utcnow(),
-                updated_at=datetime.utcnow()
-            )
-            stmt = stmt.on_conflict_do_update(
-                index_elements=['user_id'],
-                set_=dict(
-                    balance=UserBalance.balance + amount,
-                    updated_at=datetime.utcnow()
-                )
+            transaction_id = f"tx_{snowflake_id()}"
+            
+            # Upsert the balance and record the transaction in one statement
+            await db.execute(
+                _CREDIT_BALANCE_SQL,
+                {
+                    "tx_id": transaction_id,
+                    "user_id": user_id,
+                    "amount": amount,
+                    "description": description,
+                    "reference_id": reference_id,
+                    "reference_type": reference_type
+                }
             )
-            await db.execute(stmt)
-            
-            # Create transaction record
-            transaction = BalanceTransaction(
-                id=transaction_id,
-                user_id=user_id,
-                transaction_type="credit",
-                amount=amount,
-                description=description,
-                reference_id=reference_id,
-                reference_type=reference_type,
-                created_at=datetime.utcnow()
-            )
-            db.add(transaction)
             
             await db.commit()
+            await cache.invalidate_balance(user_id)
             logger.info("Balance credited successfully", user_id=user_id, amount=amount, transaction_id=transaction_id)
             return True
             
@@ -147,7 +163,7 @@ class BalanceService:
     async def debit_balance(
         self,
         user_id: str,
-        amount: float,
+        amount: Decimal,
         description: str,
         reference_id: Optional[str] = None,
         reference_type: str = "usage",
@@ -157,22 +173,22 @@ class BalanceService:
         try:
             logger.info("Debiting balance", user_id=user_id, amount=amount, reference_id=reference_id)
             
-            # Check current balance
+            # Check and deduct in one statement (no read-then-write race between concurrent debits)
             result = await db.execute(
-                select(UserBalance).where(UserBalance.user_id == user_id)
+                update(UserBalance)
+                .where(UserBalance.user_id == user_id, UserBalance.balance >= amount)
+                .values(balance=UserBalance.balance - amount, updated_at=func.now())
+                .returning(UserBalance.balance)
             )
-            user_balance = result.scalar_one_or_none()
+            remaining = result.scalar_one_or_none()
             
-            if not user_balance or user_balance.balance < amount:
-                logger.warning("Insufficient balance", user_id=user_id, required=amount, available=user_balance.balance if user_balance else 0)
+            if remaining is None:
+                await db.rollback()
+                logger.warning("Insufficient balance", user_id=user_id, required=amount)
                 return False
             
             # Generate transaction ID
-            transaction_id = f"tx_{uuid.uuid4().hex[:12]}"
-            
-            # Update balance
-            user_balance.balance -= amount
-            user_balance.updated_at = datetime.utcnow()
+            transaction_id = f"tx_{snowflake_id()}"
             
             # Create transaction record
             transaction = BalanceTransaction(
@@ -182,12 +198,12 @@ class BalanceService:
                 amount=amount,
                 description=description,
                 reference_id=reference_id,
-                reference_type=reference_type,
-                created_at=datetime.utcnow()
+                reference_type=reference_type
             )
             db.add(transaction)
             
             await db.commit()
+            await cache.set_balance(user_id, remaining)
             logger.info("Balance debited successfully", user_id=user_id, amount=amount, transaction_id=transaction_id)
             return True
             
@@ -196,14 +212,22 @@ class BalanceService:
             await db.rollback()
             raise
 
-    async def check_sufficient_balance(self, user_id: str, amount: float, db: AsyncSession) -> bool:
+    async def check_sufficient_balance(self, user_id: str, amount: Decimal, db: AsyncSession) -> bool:
         """Check if user has sufficient balance for a transaction."""
         try:
+            balance = await cache.get_balance(user_id)
+            if balance is not None:
+                return balance >= amount
+            
             result = await db.execute(
                 select(UserBalance.balance).where(UserBalance.user_id == user_id)
             )
             balance = result.scalar_one_or_none()
-            return balance is not None and balance >= amount
+            if balance is None:
+                return False
+            
+            await cache.set_balance(user_id, balance, only_if_missing=True)
+            return balance >= amount
             
         except Exception as e:
             logger.error("Error checking balance", user_id=user_id, error=str(e))
@@ -1,20 +1,36 @@
-import time
+import asyncio
 import uuid
-from typing import List, Dict, Optional
+from typing import AsyncIterator, List, Dict, Optional, Tuple
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, insert
 from ..models.chat import ChatSession, ChatMessage as ChatMessageModel
 from ..services.openrouter_service import OpenRouterService
 from ..services.lm_studio import LMStudioService
+from ..services.usage_writer import record_usage
 from ..core.config import settings
 from ..core.cache import CacheService
+from ..core.database import AsyncSessionLocal
+from ..core.ids import snowflake_id
+from ..core.timestamps import utc_timestamp
+from ..exceptions import SessionNotFoundError
 import structlog
 
 logger = structlog.get_logger()
 
+# Strong references to in-flight background persists (the loop only keeps weak ones)
+_background_tasks: set = set()
+
+
+async def drain_background_tasks():
+    """Wait for pending background persists (called on app shutdown, before the usage writer stops)."""
+    if _background_tasks:
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
+
+
 class ChatService:
-    def __init__(self, db: AsyncSession, cache: CacheService, openrouter: OpenRouterService, lm_studio: Optional[LMStudioService] = None):
-        self.db = db
+    """Stateless chat orchestration; the per-request DB session is passed to each call."""
+    
+    def __init__(self, cache: CacheService, openrouter: OpenRouterService, lm_studio: Optional[LMStudioService] = None):
         self.cache = cache
         self.openrouter = openrouter
         self.lm_studio = lm_studio
@@ -29,41 +45,42 @@ class ChatService:
             # Default to OpenRouter
             return self.openrouter
     
-    async def create_session(self) -> ChatSession:
+    async def create_session(self, db: AsyncSession) -> ChatSession:
         """Create a new chat session"""
         session_id = f"sess_{uuid.uuid4().hex[:12]}"
         session = ChatSession(session_id=session_id)
-        self.db.add(session)
-        await self.db.commit()
+        db.add(session)
+        await db.commit()
         
         logger.info("Session created", session_id=session_id)
         return session
     
-    async def get_session(self, session_id: str) -> Optional[ChatSession]:
+    async def get_session(self, db: AsyncSession, session_id: str) -> Optional[ChatSession]:
         """Get session by ID"""
-        result = await self.db.execute(
+        result = await db.execute(
             select(ChatSession).where(ChatSession.session_id == session_id)
         )
         return result.scalar_one_or_none()
     
     async def send_message(
         self, 
+        db: AsyncSession,
         session_id: str, 
         message: str, 
         max_tokens: int = 1000,
         temperature: float = 0.7,
         use_cache: bool = True,
         model: Optional[str] = None,
-        backend: Optional[str] = None
+        backend: Optional[str] = None,
+        background_persist: bool = True
     ) -> Dict:
-        """Send message and get response"""
-        # Validate session exists
-        session = await self.get_session(session_id)
-        if not session:
-            raise ValueError(f"Session {session_id} not found")
+        """Send message and get response
         
-        # Get conversation history
-        message_history = await self._get_message_history(session_id)
+        With background_persist the exchange is stored after the response is returned,
+        on its own session; pass False to commit before returning.
+        """
+        # Validate session and get conversation history in one round trip
+        message_history, generation = await self._load_session_and_history(db, session_id)
         message_history.append({"role": "user", "content": message})
         
         # Call selected LLM service
@@ -71,22 +88,141 @@ class ChatService:
         result = await llm_service.chat_completion(
             messages=message_history,
             session_id=session_id,
-            db=self.db,
             max_tokens=max_tokens,
             temperature=temperature,
             use_cache=use_cache,
             model=model
         )
         
+        # The reply's id is assigned now, so the one returned is the one stored (and in history)
+        # (the user turn's id is taken first, so ordering by id keeps the pair in order)
+        user_message_id, message_id = snowflake_id(), snowflake_id()
+        
+        # The next request must see this turn even if the persist below hasn't committed yet
+        cached = await self._cache_turn(session_id, message, result, generation)
+        
+        # Usage row plus (for fresh completions) the user/assistant messages, one commit
+        if background_persist:
+            task = asyncio.create_task(self._persist_completion(
+                session_id, result, message, user_message_id, message_id, cached
+            ))
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+        else:
+            await self._commit_completion(db, session_id, result, message, user_message_id, message_id, cached)
+        
         return {
-            "id": f"msg_{uuid.uuid4().hex[:12]}",
+            "id": f"msg_{message_id}",
             "content": result["response"],
             "role": "assistant",
-            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+            "created_at": utc_timestamp()
         }
     
+    async def stream_message(
+        self,
+        db: AsyncSession,
+        session_id: str,
+        message: str,
+        max_tokens: int = 1000,
+        temperature: float = 0.7,
+        use_cache: bool = True,
+        model: Optional[str] = None,
+        backend: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """Validate the session and load history, then return an iterator of response text deltas"""
+        # Done before the response starts so an unknown session is still a 404
+        message_history, generation = await self._load_session_and_history(db, session_id)
+        message_history.append({"role": "user", "content": message})
+        
+        llm_service = self._get_llm_service(backend)
+        return self._stream_and_store(
+            llm_service, session_id, message_history, generation, max_tokens, temperature, use_cache, model
+        )
+    
+    async def _stream_and_store(
+        self,
+        llm_service,
+        session_id: str,
+        messages: List[Dict],
+        generation: Optional[bytes],
+        max_tokens: int,
+        temperature: float,
+        use_cache: bool,
+        model: Optional[str]
+    ) -> AsyncIterator[str]:
+        # Both backends stream; summary is filled in once the stream is exhausted
+        summary: Dict = {}
+        async for delta in llm_service.stream_completion(
+            messages, session_id, summary,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            use_cache=use_cache,
+            model=model
+        ):
+            yield delta
+        
+        user_content = messages[-1]["content"]
+        cached = await self._cache_turn(session_id, user_content, summary, generation)
+        
+        # The request-scoped session is closed before a streamed body runs, so store on our own
+        user_message_id, message_id = snowflake_id(), snowflake_id()
+        await self._persist_completion(session_id, summary, user_content, user_message_id, message_id, cached)
+    
+    async def _cache_turn(
+        self, session_id: str, user_content: str, result: Dict, generation: Optional[bytes]
+    ) -> bool:
+        """Append the user turn and reply to the cached history before they are committed.
+        
+        generation is the one the history was read at. Returns False when the cached copy
+        was dropped instead (another write got there first), so the caller must drop it
+        again once the turn is committed. Cache hits store nothing.
+        """
+        if result["status"] == "cache_hit":
+            return True
+        return await self.cache.append_history(session_id, [
+            {"role": "user", "content": user_content},
+            {"role": "assistant", "content": result["response"]}
+        ], generation)
+    
+    async def _persist_completion(
+        self, session_id: str, result: Dict, user_content: str, user_message_id: int, message_id: int, cached: bool
+    ) -> None:
+        # Runs after the response is sent; SQLAlchemy sessions can't be shared across tasks
+        async with AsyncSessionLocal() as db:
+            await self._commit_completion(db, session_id, result, user_content, user_message_id, message_id, cached)
+    
+    async def _commit_completion(
+        self,
+        db: AsyncSession,
+        session_id: str,
+        result: Dict,
+        user_content: str,
+        user_message_id: int,
+        message_id: int,
+        cached: bool
+    ) -> None:
+        """Store a completion and commit; failures are logged, not raised
+        
+        If the cached history already holds this turn (cached, see _cache_turn) it is dropped
+        only if the commit fails; otherwise it is dropped after the commit, so a refill that
+        ran in between can't outlive it.
+        """
+        try:
+            stored = await self._store_completion(
+                db, session_id, result, message_id, user_content=user_content, user_message_id=user_message_id
+            )
+            if stored:  # cache hits store no messages, so skip the commit round trip
+                await db.commit()
+                if not cached:
+                    await self.cache.invalidate_history(session_id)
+        except Exception as e:
+            logger.error("Failed to store messages", error=str(e), session_id=session_id)
+            await db.rollback()
+            await self.cache.invalidate_history(session_id)
+    
     async def send_text_message(
         self,
+        db: AsyncSession,
         session_id: str,
         message: str,
         image_filename: Optional[str] = None,
@@ -98,22 +234,11 @@ class ChatService:
     ) -> Dict:
         """Send text message with optional image filename reference"""
         # Validate session exists
-        session = await self.get_session(session_id)
+        session = await self.get_session(db, session_id)
         if not session:
-            raise ValueError(f"Session {session_id} not found")
+            raise SessionNotFoundError(session_id)
         
         try:
-            # Store user message with image filename reference if provided
-            user_msg = ChatMessageModel(
-                session_id=session_id,
-                role="user",
-                content=message,
-                image_url=image_filename  # Store filename reference in existing field
-            )
-            self.db.add(user_msg)
-            
-            await self.db.commit()
-            
             # Send only the text message to AI (no conversation history)
             text_only_messages = [{"role": "user", "content": message}]
             
@@ -122,13 +247,24 @@ class ChatService:
             result = await llm_service.chat_completion(
                 messages=text_only_messages,
                 session_id=session_id,
-                db=self.db,
                 max_tokens=max_tokens,
                 temperature=temperature,
                 use_cache=use_cache,
                 model=model
             )
             
+            # User message (with image filename reference if provided) is stored even on a cache hit
+            user_message_id, message_id = snowflake_id(), snowflake_id()
+            await self._store_completion(
+                db, session_id, result, message_id,
+                user_content=message,
+                user_message_id=user_message_id,
+                image_filename=image_filename,
+                store_user_on_cache_hit=True
+            )
+            await db.commit()
+            await self.cache.invalidate_history(session_id)
+            
             logger.info(
                 "Text message processed successfully",
                 session_id=session_id,
@@ -137,64 +273,134 @@ class ChatService:
             )
             
             return {
-                "id": f"msg_{uuid.uuid4().hex[:12]}",
+                "id": f"msg_{message_id}",
                 "content": result["response"],
                 "role": "assistant",
-                "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "created_at": utc_timestamp(),
                 "image_filename": image_filename
             }
             
         except Exception as e:
             logger.error("Failed to save text message", error=str(e), session_id=session_id)
-            await self.db.rollback()
+            await db.rollback()
             raise
     
-    async def get_message_history(self, session_id: str) -> List[Dict]:
-        """Get all messages for a session"""
-        # Validate session exists
-        session = await self.get_session(session_id)
-        if not session:
-            raise ValueError(f"Session {session_id} not found")
+    async def _store_completion(
+        self,
+        db: AsyncSession,
+        session_id: str,
+        result: Dict,
+        message_id: int,
+        user_content: Optional[str] = None,
+        user_message_id: Optional[int] = None,
+        image_filename: Optional[str] = None,
+        store_user_on_cache_hit: bool = False
+    ) -> List[Dict]:
+        """Queue the usage row for a completion and insert its chat_messages rows (user
+        message if given, assistant reply unless it was a cache hit) as one multi-row
+        INSERT. The assistant row gets message_id and the user row user_message_id, which
+        must be the smaller so the pair sorts in order. The caller commits. Returns the stored
+        messages as history entries."""
+        record_usage(session_id, "chat", result["tokens_used"], result["response_time"], result["status"])
+        
+        cache_hit = result["status"] == "cache_hit"
+        # Every row carries the same keys so they go out in a single INSERT ... VALUES (...), (...)
+        rows = []
+        if user_content is not None and (store_user_on_cache_hit or not cache_hit):
+            rows.append({
+                "id": user_message_id,
+                "session_id": session_id,
+                "role": "user",
+                "content": user_content,
+                "image_url": image_filename,  # Store filename reference in existing field
+                "tokens_used": None,
+                "response_time": None,
+                "model_used": None
+            })
+        if not cache_hit:
+            rows.append({
+                "id": message_id,
+                "session_id": session_id,
+                "role": "assistant",
+                "content": result["response"],
+                "image_url": None,
+                "tokens_used": result["tokens_used"],
+                "response_time": result["response_time"],
+                "model_used": result["model_used"]
+            })
         
-        result = await self.db.execute(
-            select(ChatMessageModel)
-            .where(ChatMessageModel.session_id == session_id)
-            .order_by(ChatMessageModel.created_at)
+        if rows:
+            await db.execute(insert(ChatMessageModel), rows)
+        return [{"role": row["role"], "content": row["content"]} for row in rows]
+    
+    async def get_message_history(self, db: AsyncSession, session_id: str) -> List[Dict]:
+        """Get all messages for a session"""
+        # Only the columns the API exposes (skips message_metadata JSON decode and ORM instances).
+        # LEFT JOIN from the session validates it in the same round trip: no rows means
+        # no session, a single all-NULL message row means a session without messages.
+        result = await db.execute(
+            select(
+                ChatMessageModel.id,
+                ChatMessageModel.role,
+                ChatMessageModel.content,
+                ChatMessageModel.image_url,
+                ChatMessageModel.created_at
+            )
+            .select_from(ChatSession)
+            .outerjoin(ChatMessageModel, ChatMessageModel.session_id == ChatSession.session_id)
+            .where(ChatSession.session_id == session_id)
+            .order_by(ChatMessageModel.created_at, ChatMessageModel.id)
         )
-        messages = result.scalars().all()
+        messages = result.all()
+        if not messages:
+            raise SessionNotFoundError(session_id)
         
         return [
             {
-                "id": f"msg_{uuid.uuid4().hex[:12]}",
+                "id": f"msg_{msg.id}",  # stable across requests (row primary key)
                 "role": msg.role,
                 "content": msg.content,
-                "created_at": msg.created_at.strftime("%Y-%m-%dT%H:%M:%SZ") if hasattr(msg.created_at, 'strftime') else str(msg.created_at),
+                # UTC datetime; isoformat's first 19 chars are the YYYY-MM-DDTHH:MM:SS part
+                "created_at": msg.created_at.isoformat(timespec="seconds")[:19] + "Z",
                 "image_filename": msg.image_url  # Reusing image_url field for filename
             }
             for msg in messages
+            if msg.role is not None
         ]
     
-    async def delete_session(self, session_id: str) -> None:
+    async def delete_session(self, db: AsyncSession, session_id: str) -> None:
         """Delete session and all messages"""
-        # Delete messages
-        await self.db.execute(
-            ChatMessageModel.__table__.delete().where(ChatMessageModel.session_id == session_id)
-        )
-        
-        # Delete session
-        await self.db.execute(
+        # Messages go with it via ON DELETE CASCADE
+        await db.execute(
             ChatSession.__table__.delete().where(ChatSession.session_id == session_id)
         )
         
-        await self.db.commit()
+        await db.commit()
+        await self.cache.invalidate_history(session_id)
         logger.info("Session deleted", session_id=session_id)
     
-    async def _get_message_history(self, session_id: str) -> List[Dict]:
-        """Get conversation history for API call"""
-        result = await self.db.execute(
-            select(ChatMessageModel)
-            .where(ChatMessageModel.session_id == session_id)
-            .order_by(ChatMessageModel.created_at)
+    async def _load_session_and_history(self, db: AsyncSession, session_id: str) -> Tuple[List[Dict], Optional[bytes]]:
+        """Get conversation history for API call, raising SessionNotFoundError if the session doesn't exist,
+        plus the cache generation it was read at (for _cache_turn)
+        
+        Served from the Redis copy when present (only existing sessions are cached).
+        Otherwise a LEFT JOIN from the session: no rows means no session, a single
+        all-NULL message row means a session without messages.
+        """
+        cached, generation = await self.cache.get_history(session_id)
+        if cached is not None:
+            return cached, generation
+        
+        result = await db.execute(
+            select(ChatMessageModel.role, ChatMessageModel.content)
+            .select_from(ChatSession)
+            .outerjoin(ChatMessageModel, ChatMessageModel.session_id == ChatSession.session_id)
+            .where(ChatSession.session_id == session_id)
+            .order_by(ChatMessageModel.created_at, ChatMessageModel.id)
         )
-        messages = result.scalars().all()
-        return [{"role": msg.role, "content": msg.content} for msg in messages]
\ No newline at end of file
+        rows = result.all()
+        if not rows:
+            raise SessionNotFoundError(session_id)
+        history = [{"role": role, "content": content} for role, content in rows if role is not None]
+        await self.cache.set_history(session_id, history, generation)
+        return history, generation
\ No newline at end of file
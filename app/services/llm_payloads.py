@@ -0,0 +1,22 @@
+"""
+OpenAI-compatible chat completion payloads (shared by OpenRouter and LM Studio)
+Requests are encoded with orjson; responses decode straight into the few fields we read.
+"""
+from typing import List, Optional
+import msgspec
+
+class CompletionMessage(msgspec.Struct):
+    content: Optional[str] = None
+
+class CompletionChoice(msgspec.Struct):
+    message: CompletionMessage
+
+class CompletionUsage(msgspec.Struct):
+    total_tokens: int = 0
+
+class ChatCompletion(msgspec.Struct):
+    choices: List[CompletionChoice]
+    usage: Optional[CompletionUsage] = None
+
+# Unknown fields in the provider response are skipped by the decoder
+COMPLETION_DECODER = msgspec.json.Decoder(ChatCompletion)
@@ -1,11 +1,13 @@
 import time
-import uuid
-from typing import List, Dict, Optional
+from typing import AsyncIterator, List, Dict, Optional
 import httpx
-from sqlalchemy.ext.asyncio import AsyncSession
+import msgspec
+import orjson
 from ..core.config import settings
 from ..core.cache import cache
-from ..models.chat import ChatMessage as ChatMessageModel, ApiUsage
+from ..exceptions import ProviderError, classify_provider_error
+from .usage_writer import record_usage
+from .llm_payloads import COMPLETION_DECODER
 import structlog
 
 logger = structlog.get_logger()
@@ -14,37 +16,47 @@ class LMStudioService:
     def __init__(self):
         self.base_url = settings.LM_STUDIO_URL
         self.timeout = 30.0
+        # Shared client so keep-alive connections are reused across requests
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=self.timeout,
+            headers={"Content-Type": "application/json"},
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100)
+        )
+    
+    async def aclose(self):
+        await self._client.aclose()
         
     async def chat_completion(
         self, 
         messages: List[Dict[str, str]], 
         session_id: str,
-        db: AsyncSession,
         max_tokens: int = 1000, 
         temperature: float = 0.7,
         use_cache: bool = True,
         model: Optional[str] = None
     ) -> Dict:
-        start_time = time.time()
+        start_time = time.perf_counter()
         
         try:
             # Check cache first
             if use_cache:
-                cached_response = cache.get_chat_response(messages)
+                cache_key, cached_response = await cache.get_chat_response(messages)
                 if cached_response:
-                    response_time = time.time() - start_time
-                    logger.info("Cache hit for chat completion", 
-                              session_id=session_id, 
-                              response_time=response_time)
+                    response_time = time.perf_counter() - start_time
+                    logger.debug("Cache hit for chat completion", 
+                               session_id=session_id, 
+                               response_time=response_time)
                     
-                    await self._log_usage(db, session_id, "chat", 0, response_time, "cache_hit")
-                    return {"response": cached_response}
+                    return {
+                        "response": cached_response,
+                        "status": "cache_hit",
+                        "tokens_used": 0,
+                        "response_time": response_time,
+                        "model_used": None
+                    }
             
             # Make API call to LM Studio
-            headers = {
-                "Content-Type": "application/json"
-            }
-            
             selected_model = model or settings.LM_STUDIO_DEFAULT_MODEL
             payload = {
                 "model": selected_model,
@@ -54,121 +66,172 @@ class LMStudioService:
                 "stream": False
             }
             
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
-                response = await client.post(
-                    f"{self.base_url}/v1/chat/completions",
-                    headers=headers,
-                    json=payload
-                )
-                response.raise_for_status()
-                result = response.json()
-                
-                response_time = time.time() - start_time
-                assistant_response = result["choices"][0]["message"]["content"]
-                usage_info = result.get("usage", {})
-                tokens_used = usage_info.get("total_tokens", 0)
-                
-                # Cache the response
-                if use_cache:
-                    cache.set_chat_response(messages, assistant_response)
-                
-                # Log to database
-                await self._log_usage(db, session_id, "chat", tokens_used, response_time, "success")
-                
-                # Store chat messages
-                await self._store_messages(db, session_id, messages, assistant_response, tokens_used, response_time, selected_model)
-                
-                logger.info(
-                    "LM Studio chat completion successful",
-                    session_id=session_id,
-                    tokens_used=tokens_used,
-                    response_time=response_time
-                )
-                
-                return {
-                    "response": assistant_response
-                }
-                
+            response = await self._client.post("/v1/chat/completions", content=orjson.dumps(payload))
+            response.raise_for_status()
+            result = COMPLETION_DECODER.decode(response.content)
+            
+            response_time = time.perf_counter() - start_time
+            assistant_response = result.choices[0].message.content
+            tokens_used = result.usage.total_tokens if result.usage else 0
+            
+            # Cache the response (the Redis write happens after we return)
+            if use_cache:
+                cache.store_chat_response(cache_key, assistant_response)
+            
+            logger.debug(
+                "LM Studio chat completion successful",
+                session_id=session_id,
+                tokens_used=tokens_used,
+                response_time=response_time
+            )
+            
+            # Usage and message rows are persisted by the caller in one commit
+            return {
+                "response": assistant_response,
+                "status": "success",
+                "tokens_used": tokens_used,
+                "response_time": response_time,
+                "model_used": selected_model
+            }
+            
         except httpx.HTTPStatusError as e:
-            response_time = time.time() - start_time
-            error_msg = f"LM Studio API error: {e.response.status_code} - {e.response.text}"
-            await self._log_usage(db, session_id, "chat", 0, response_time, "api_error", error_msg)
+            response_time = time.perf_counter() - start_time
+            body = e.response.text
+            error_msg = f"LM Studio API error: {e.response.status_code} - {body}"
+            record_usage(session_id, "chat", 0, response_time, "api_error", error_msg)
             logger.error("LM Studio API error", session_id=session_id, error=error_msg)
-            raise Exception(error_msg)
+            raise classify_provider_error(e.response.status_code, error_msg, body) from e
             
         except httpx.RequestError as e:
-            response_time = time.time() - start_time
+            response_time = time.perf_counter() - start_time
             error_msg = f"Request error: {str(e)}"
-            await self._log_usage(db, session_id, "chat", 0, response_time, "request_error", error_msg)
+            record_usage(session_id, "chat", 0, response_time, "request_error", error_msg)
             logger.error("Request error", session_id=session_id, error=error_msg)
-            raise Exception(error_msg)
+            raise ProviderError(error_msg, kind="request") from e
             
-        except Exception as e:
-            response_time = time.time() - start_time
-            error_msg = f"Unexpected error: {str(e)}"
-            await self._log_usage(db, session_id, "chat", 0, response_time, "error", error_msg)
-            logger.error("Unexpected error", session_id=session_id, error=error_msg)
-            raise Exception(error_msg)
+        except (msgspec.DecodeError, IndexError) as e:
+            # Body that isn't a completion (bad JSON, missing fields, no choices)
+            response_time = time.perf_counter() - start_time
+            error_msg = f"Invalid response: {str(e)}"
+            record_usage(session_id, "chat", 0, response_time, "error", error_msg)
+            logger.error("Invalid response", session_id=session_id, error=error_msg)
+            raise ProviderError(error_msg, kind="response") from e
     
-    async def _log_usage(
-        self, 
-        db: AsyncSession, 
-        session_id: str, 
-        endpoint: str, 
-        tokens_used: int, 
-        response_time: float, 
-        status: str, 
-        error_message: Optional[str] = None
-    ):
-        try:
-            usage = ApiUsage(
-                session_id=session_id,
-                endpoint=endpoint,
-                tokens_used=tokens_used,
-                response_time=response_time,
-                success=status,
-                error_message=error_message
-            )
-            db.add(usage)
-            await db.commit()
-        except Exception as e:
-            logger.error("Failed to log usage", error=str(e))
-            await db.rollback()
+    def _stream_error(self, error, session_id: str, response_time: float) -> ProviderError:
+        """Record and log an error sent as a stream chunk (the status was already 200);
+        returns the typed exception to raise"""
+        code = error.get("code") if isinstance(error, dict) else None
+        status_code = code if isinstance(code, int) else 502
+        body = orjson.dumps(error).decode()[:1024]
+        error_msg = f"LM Studio stream error: {status_code} - {body}"
+        record_usage(session_id, "chat", 0, response_time, "error", error_msg)
+        logger.error("LM Studio stream error", session_id=session_id, status_code=status_code, error=error_msg)
+        return classify_provider_error(status_code, error_msg, body)
     
-    async def _store_messages(
-        self, 
-        db: AsyncSession, 
-        session_id: str, 
-        messages: List[Dict[str, str]], 
-        assistant_response: str, 
-        tokens_used: int, 
-        response_time: float,
-        model_used: Optional[str] = None
-    ):
+    async def stream_completion(
+        self,
+        messages: List[Dict[str, str]],
+        session_id: str,
+        summary: Dict,
+        max_tokens: int = 1000,
+        temperature: float = 0.7,
+        use_cache: bool = True,
+        model: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """Yield response text deltas as LM Studio generates them.
+        
+        Once the stream is exhausted, summary holds the same keys chat_completion returns.
+        """
+        start_time = time.perf_counter()
+        
+        if use_cache:
+            cache_key, cached_response = await cache.get_chat_response(messages)
+            if cached_response:
+                summary.update(
+                    response=cached_response,
+                    status="cache_hit",
+                    tokens_used=0,
+                    response_time=time.perf_counter() - start_time,
+                    model_used=None
+                )
+                yield cached_response
+                return
+        
+        selected_model = model or settings.LM_STUDIO_DEFAULT_MODEL
+        payload = {
+            "model": selected_model,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "stream": True
+        }
+        
+        parts = []
+        tokens_used = 0
         try:
-            # Store user message (last message in the list)
-            user_message = messages[-1]
-            user_msg = ChatMessageModel(
-                session_id=session_id,
-                role=user_message["role"],
-                content=user_message["content"]
-            )
-            db.add(user_msg)
-            
-            # Store assistant response
-            assistant_msg = ChatMessageModel(
-                session_id=session_id,
-                role="assistant",
-                content=assistant_response,
-                tokens_used=tokens_used,
-                response_time=response_time,
-                model_used=model_used or settings.LM_STUDIO_DEFAULT_MODEL
-            )
-            db.add(assistant_msg)
-            
-            await db.commit()
-        except Exception as e:
-            logger.error("Failed to store messages", error=str(e))
-            await db.rollback()
+            async with self._client.stream("POST", "/v1/chat/completions", content=orjson.dumps(payload)) as response:
+                if response.is_error:
+                    await response.aread()
+                    response.raise_for_status()
+                
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: "):
+                        continue
+                    data = line[6:]
+                    if data == "[DONE]":
+                        break
+                    
+                    chunk = orjson.loads(data)
+                    if chunk.get("error"):
+                        raise self._stream_error(chunk["error"], session_id, time.perf_counter() - start_time)
+                    usage_info = chunk.get("usage")
+                    if usage_info:
+                        tokens_used = usage_info.get("total_tokens", 0)
+                    choices = chunk.get("choices")
+                    if choices:
+                        delta = choices[0].get("delta", {}).get("content")
+                        if delta:
+                            parts.append(delta)
+                            yield delta
+        
+        except httpx.HTTPStatusError as e:
+            body = e.response.text
+            error_msg = f"LM Studio API error: {e.response.status_code} - {body}"
+            record_usage(session_id, "chat", 0, time.perf_counter() - start_time, "api_error", error_msg)
+            logger.error("LM Studio API error", session_id=session_id, error=error_msg)
+            raise classify_provider_error(e.response.status_code, error_msg, body) from e
+        
+        except httpx.RequestError as e:
+            error_msg = f"Request error: {str(e)}"
+            record_usage(session_id, "chat", 0, time.perf_counter() - start_time, "request_error", error_msg)
+            logger.error("Request error", session_id=session_id, error=error_msg)
+            raise ProviderError(error_msg, kind="request") from e
+        
+        except orjson.JSONDecodeError as e:
+            error_msg = f"Invalid response: {str(e)}"
+            record_usage(session_id, "chat", 0, time.perf_counter() - start_time, "error", error_msg)
+            logger.error("Invalid response", session_id=session_id, error=error_msg)
+            raise ProviderError(error_msg, kind="response") from e
+        
+        response_time = time.perf_counter() - start_time
+        assistant_response = "".join(parts)
+        
+        if use_cache:
+            cache.store_chat_response(cache_key, assistant_response)
+        
+        logger.debug(
+            "LM Studio chat completion streamed",
+            session_id=session_id,
+            tokens_used=tokens_used,
+            response_time=response_time
+        )
+        
+        summary.update(
+            response=assistant_response,
+            status="success",
+            tokens_used=tokens_used,
+            response_time=response_time,
+            model_used=selected_model
+        )
 
 lm_studio_service = LMStudioService()
\ No newline at end of file
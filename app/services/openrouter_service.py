@@ -1,228 +1,374 @@
+import asyncio
 import time
-import uuid
-from typing import List, Dict, Optional
+from collections import defaultdict
+from typing import AsyncIterator, List, Dict, Optional
 import httpx
-from sqlalchemy.ext.asyncio import AsyncSession
+import msgspec
+import orjson
+from cachetools import TTLCache
 from ..core.config import settings
 from ..core.cache import cache
-from ..models.chat import ChatMessage as ChatMessageModel, ApiUsage
+from ..exceptions import ProviderError, classify_provider_error
+from .usage_writer import record_usage
+from .llm_payloads import COMPLETION_DECODER
 import structlog
 
 logger = structlog.get_logger()
 
+# Map legacy model names to OpenRouter model IDs
+_MODEL_MAPPING = {
+    "gpt-oss-120b": "meta-llama/llama-3.1-8b-instruct",
+    "llama3.1-8b": "meta-llama/llama-3.1-8b-instruct",
+    "llama-3.3-70b": "meta-llama/llama-3.3-70b-instruct",
+    "llama3.1-70b": "meta-llama/llama-3.1-70b-instruct"
+}
+
+# Fields shared by every completion request; per-call fields are merged over a copy
+_PAYLOAD_TEMPLATE = {
+    "provider": {"only": ("Cerebras",)}
+}
+
+# The models catalog changes on the order of hours; per-provider lists are reused for this long
+MODELS_TTL = 600
+
 class OpenRouterService:
     def __init__(self):
         self.api_key = settings.OPENROUTER_API_KEY
         self.base_url = settings.OPENROUTER_BASE_URL
         self.timeout = 30.0
+        # Shared HTTP/2 client: concurrent completions multiplex as streams over one
+        # TLS connection instead of each opening (and handshaking) its own
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            http2=True,
+            timeout=httpx.Timeout(self.timeout),
+            headers={
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json"
+            },
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=50)
+        )
+        self._http_version_logged = False
+        # (cache key, model, temperature, max_tokens) -> future of the reply, for completions in flight
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        self._models_cache = TTLCache(maxsize=64, ttl=MODELS_TTL)
+        self._models_locks = defaultdict(asyncio.Lock)
+    
+    async def aclose(self):
+        await self._client.aclose()
         
     async def fetch_available_models(self, provider: str = "openrouter") -> List[Dict]:
-        """Fetch available models from OpenRouter for a specific provider"""
+        """Fetch available models from OpenRouter for a specific provider (cached for MODELS_TTL)"""
+        cached = self._models_cache.get(provider)
+        if cached is not None:
+            return cached
+        
+        # Single flight: concurrent misses for a provider wait on one /models request
+        async with self._models_locks[provider]:
+            cached = self._models_cache.get(provider)
+            if cached is not None:
+                return cached
+            return await self._fetch_available_models(provider)
+    
+    async def _fetch_available_models(self, provider: str) -> List[Dict]:
         try:
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
-            }
+            response = await self._client.get("/models")
+            if response.is_error:
+                logger.error("Failed to fetch models from OpenRouter", status_code=response.status_code)
+                return []
+            result = orjson.loads(response.content)
+            
+            # Filter for specific provider (OpenRouter model ids are "<provider>/<model>")
+            prefix = provider.lower() + "/"
+            provider_models = [
+                {
+                    "id": model_id,
+                    "name": model.get("name", model_id),
+                    "description": model.get("description", ""),
+                    "context_length": model.get("context_length", 32000)
+                }
+                for model in result.get("data", [])
+                if (model_id := model.get("id", "")).lower().startswith(prefix)
+            ]
+            
+            logger.info("Fetched models", provider=provider, count=len(provider_models))
+            self._models_cache[provider] = provider_models  # failures (below) are not cached
+            return provider_models
             
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
-                response = await client.get(
-                    f"{self.base_url}/models",
-                    headers=headers
-                )
-                response.raise_for_status()
-                result = response.json()
-                
-                # Filter for specific provider
-                provider_models = []
-                for model in result.get("data", []):
-                    model_id = model.get("id", "")
-                    if provider.lower() in model_id.lower():
-                        provider_models.append({
-                            "id": model_id,
-                            "name": model.get("name", model_id),
-                            "description": model.get("description", ""),
-                            "context_length": model.get("context_length", 32000)
-                        })
-                
-                logger.info(f"Fetched {len(provider_models)} models for provider {provider}")
-                return provider_models
-                
         except Exception as e:
-            logger.error(f"Failed to fetch models from OpenRouter: {str(e)}")
+            logger.error("Failed to fetch models from OpenRouter", error=str(e))
             return []
     
     async def chat_completion(
         self, 
         messages: List[Dict[str, str]], 
         session_id: str,
-        db: AsyncSession,
         max_tokens: int = 1000, 
         temperature: float = 0.7,
         use_cache: bool = True,
         model: Optional[str] = None,
         provider: str = "openrouter"
     ) -> Dict:
-        start_time = time.time()
+        start_time = time.perf_counter()
         
-        try:
-            # Check cache first
-            if use_cache:
-                cached_response = cache.get_chat_response(messages)
-                if cached_response:
-                    response_time = time.time() - start_time
-                    logger.info("Cache hit for chat completion", 
-                              session_id=session_id, 
-                              response_time=response_time)
-                    
-                    await self._log_usage(db, session_id, "chat", 0, response_time, "cache_hit")
-                    return {"response": cached_response}
+        # Check cache first
+        cache_key = None
+        if use_cache:
+            cache_key, cached_response = await cache.get_chat_response(messages)
+            if cached_response:
+                response_time = time.perf_counter() - start_time
+                logger.debug("Cache hit for chat completion", 
+                           session_id=session_id, 
+                           response_time=response_time)
+                
+                return {
+                    "response": cached_response,
+                    "status": "cache_hit",
+                    "tokens_used": 0,
+                    "response_time": response_time,
+                    "model_used": None
+                }
             
-            # Make API call
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
-            }
+            # Single flight: a question already on its way upstream is awaited, not sent again.
+            # The follower is answered exactly as a cache hit would be (same key, no tokens spent).
+            # Only a flight with the same generation parameters is shared.
+            flight_key = (cache_key, model, temperature, max_tokens)
+            inflight = self._inflight.get(flight_key)
+            if inflight is not None:
+                try:
+                    shared_response = await asyncio.shield(inflight)
+                except asyncio.CancelledError:
+                    if not inflight.cancelled():
+                        raise  # this request itself was cancelled
+                    # The leader was cancelled (e.g. its client went away); ask upstream ourselves
+                    return await self._request_completion(
+                        messages, session_id, start_time, max_tokens, temperature, model, cache_key
+                    )
+                return {
+                    "response": shared_response,
+                    "status": "cache_hit",
+                    "tokens_used": 0,
+                    "response_time": time.perf_counter() - start_time,
+                    "model_used": None
+                }
             
+            inflight = self._inflight[flight_key] = asyncio.get_running_loop().create_future()
+            try:
+                result = await self._request_completion(
+                    messages, session_id, start_time, max_tokens, temperature, model, cache_key
+                )
+            except BaseException as e:
+                if isinstance(e, asyncio.CancelledError):
+                    inflight.cancel()
+                else:
+                    inflight.set_exception(e)
+                    inflight.exception()  # followers re-raise it; don't warn when there are none
+                raise
+            finally:
+                del self._inflight[flight_key]
+            inflight.set_result(result["response"])
+            return result
+        
+        return await self._request_completion(
+            messages, session_id, start_time, max_tokens, temperature, model, cache_key
+        )
+    
+    async def _request_completion(
+        self,
+        messages: List[Dict[str, str]],
+        session_id: str,
+        start_time: float,
+        max_tokens: int,
+        temperature: float,
+        model: Optional[str],
+        cache_key: Optional[str]
+    ) -> Dict:
+        """Call OpenRouter for a completion; cache_key (when set) is where the reply gets cached"""
+        try:
+            # Make API call
             # Use provided model or default
             selected_model = model or settings.DEFAULT_MODEL
             
-            # Map legacy model names to OpenRouter model IDs
-            model_mapping = {
-                "gpt-oss-120b": "meta-llama/llama-3.1-8b-instruct",
-                "llama3.1-8b": "meta-llama/llama-3.1-8b-instruct", 
-                "llama-3.3-70b": "meta-llama/llama-3.3-70b-instruct",
-                "llama3.1-70b": "meta-llama/llama-3.1-70b-instruct"
-            }
-            
             # Use mapping if available, otherwise use model as-is
-            openrouter_model = model_mapping.get(selected_model, selected_model)
+            openrouter_model = _MODEL_MAPPING.get(selected_model, selected_model)
             
-            payload = {
+            payload = _PAYLOAD_TEMPLATE | {
                 "model": openrouter_model,
-                "provider": {
-                    "only": ["Cerebras"]
-                },
                 "messages": messages,
                 "max_tokens": max_tokens,
                 "temperature": temperature
             }
             
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
-                response = await client.post(
-                    f"{self.base_url}/chat/completions",
-                    headers=headers,
-                    json=payload
-                )
-                response.raise_for_status()
-                result = response.json()
-                
-                response_time = time.time() - start_time
-                assistant_response = result["choices"][0]["message"]["content"]
-                usage_info = result.get("usage", {})
-                tokens_used = usage_info.get("total_tokens", 0)
-                
-                # Cache the response
-                if use_cache:
-                    cache.set_chat_response(messages, assistant_response)
-                
-                # Log to database
-                await self._log_usage(db, session_id, "chat", tokens_used, response_time, "success")
-                
-                # Store chat messages
-                await self._store_messages(db, session_id, messages, assistant_response, tokens_used, response_time, selected_model)
-                
-                logger.info(
-                    "Chat completion successful",
-                    session_id=session_id,
-                    model=openrouter_model,
-                    tokens_used=tokens_used,
-                    response_time=response_time
-                )
-                
-                return {
-                    "response": assistant_response
-                }
-                
-        except httpx.HTTPStatusError as e:
-            response_time = time.time() - start_time
-            error_msg = f"OpenRouter API error: {e.response.status_code} - {e.response.text}"
-            await self._log_usage(db, session_id, "chat", 0, response_time, "api_error", error_msg)
-            logger.error("OpenRouter API error", session_id=session_id, error=error_msg)
-            raise Exception(error_msg)
+            response = await self._client.post("/chat/completions", content=orjson.dumps(payload))
+            if not self._http_version_logged:
+                # Once per process, to confirm the upstream negotiated HTTP/2
+                self._http_version_logged = True
+                logger.debug("OpenRouter connection established", http_version=response.http_version)
+            if response.is_error:
+                raise self._api_error(response, session_id, time.perf_counter() - start_time)
+            result = COMPLETION_DECODER.decode(response.content)
+            
+            response_time = time.perf_counter() - start_time
+            assistant_response = result.choices[0].message.content
+            tokens_used = result.usage.total_tokens if result.usage else 0
+            
+            # Cache the response (the Redis write happens after we return)
+            if cache_key is not None:
+                cache.store_chat_response(cache_key, assistant_response)
+            
+            logger.debug(
+                "Chat completion successful",
+                session_id=session_id,
+                model=openrouter_model,
+                tokens_used=tokens_used,
+                response_time=response_time
+            )
+            
+            # Usage and message rows are persisted by the caller in one commit
+            return {
+                "response": assistant_response,
+                "status": "success",
+                "tokens_used": tokens_used,
+                "response_time": response_time,
+                "model_used": selected_model
+            }
             
         except httpx.RequestError as e:
-            response_time = time.time() - start_time
+            response_time = time.perf_counter() - start_time
             error_msg = f"Request error: {str(e)}"
-            await self._log_usage(db, session_id, "chat", 0, response_time, "request_error", error_msg)
+            record_usage(session_id, "chat", 0, response_time, "request_error", error_msg)
             logger.error("Request error", session_id=session_id, error=error_msg)
-            raise Exception(error_msg)
+            raise ProviderError(error_msg, kind="request") from e
             
-        except Exception as e:
-            response_time = time.time() - start_time
-            error_msg = f"Unexpected error: {str(e)}"
-            await self._log_usage(db, session_id, "chat", 0, response_time, "error", error_msg)
-            logger.error("Unexpected error", session_id=session_id, error=error_msg)
-            raise Exception(error_msg)
+        except (msgspec.DecodeError, IndexError) as e:
+            # Body that isn't a completion (bad JSON, missing fields, no choices)
+            response_time = time.perf_counter() - start_time
+            error_msg = f"Invalid response: {str(e)}"
+            record_usage(session_id, "chat", 0, response_time, "error", error_msg)
+            logger.error("Invalid response", session_id=session_id, error=error_msg)
+            raise ProviderError(error_msg, kind="response") from e
     
-    async def _log_usage(
-        self, 
-        db: AsyncSession, 
-        session_id: str, 
-        endpoint: str, 
-        tokens_used: int, 
-        response_time: float, 
-        status: str, 
-        error_message: Optional[str] = None
-    ):
-        try:
-            usage = ApiUsage(
-                session_id=session_id,
-                endpoint=endpoint,
-                tokens_used=tokens_used,
-                response_time=response_time,
-                success=status,
-                error_message=error_message
-            )
-            db.add(usage)
-            await db.commit()
-        except Exception as e:
-            logger.error("Failed to log usage", error=str(e))
-            await db.rollback()
+    def _api_error(self, response: httpx.Response, session_id: str, response_time: float) -> ProviderError:
+        """Record and log an upstream error response; returns the typed exception to raise"""
+        # Error pages (e.g. 5xx HTML from the edge) are truncated before they reach logs and api_usage
+        body = response.content[:1024].decode("utf-8", errors="replace")
+        error_msg = f"OpenRouter API error: {response.status_code} - {body}"
+        record_usage(session_id, "chat", 0, response_time, "api_error", error_msg)
+        logger.error("OpenRouter API error", session_id=session_id, status_code=response.status_code, error=error_msg)
+        return classify_provider_error(response.status_code, error_msg, body)
     
-    async def _store_messages(
-        self, 
-        db: AsyncSession, 
-        session_id: str, 
-        messages: List[Dict[str, str]], 
-        assistant_response: str, 
-        tokens_used: int, 
-        response_time: float,
-        model_used: Optional[str] = None
-    ):
+    def _stream_error(self, error, session_id: str, response_time: float) -> ProviderError:
+        """Record and log an error sent as a stream chunk (the status was already 200);
+        returns the typed exception to raise"""
+        code = error.get("code") if isinstance(error, dict) else None
+        status_code = code if isinstance(code, int) else 502
+        body = orjson.dumps(error).decode()[:1024]
+        error_msg = f"OpenRouter stream error: {status_code} - {body}"
+        record_usage(session_id, "chat", 0, response_time, "error", error_msg)
+        logger.error("OpenRouter stream error", session_id=session_id, status_code=status_code, error=error_msg)
+        return classify_provider_error(status_code, error_msg, body)
+    
+    async def stream_completion(
+        self,
+        messages: List[Dict[str, str]],
+        session_id: str,
+        summary: Dict,
+        max_tokens: int = 1000,
+        temperature: float = 0.7,
+        use_cache: bool = True,
+        model: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """Yield response text deltas as OpenRouter generates them.
+        
+        Once the stream is exhausted, summary holds the same keys chat_completion returns.
+        """
+        start_time = time.perf_counter()
+        
+        if use_cache:
+            cache_key, cached_response = await cache.get_chat_response(messages)
+            if cached_response:
+                summary.update(
+                    response=cached_response,
+                    status="cache_hit",
+                    tokens_used=0,
+                    response_time=time.perf_counter() - start_time,
+                    model_used=None
+                )
+                yield cached_response
+                return
+        
+        selected_model = model or settings.DEFAULT_MODEL
+        openrouter_model = _MODEL_MAPPING.get(selected_model, selected_model)
+        payload = _PAYLOAD_TEMPLATE | {
+            "model": openrouter_model,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "stream": True,
+            "usage": {"include": True}  # token counts arrive on the final chunk
+        }
+        
+        parts = []
+        tokens_used = 0
         try:
-            # Store user message (last message in the list)
-            user_message = messages[-1]
-            user_msg = ChatMessageModel(
-                session_id=session_id,
-                role=user_message["role"],
-                content=user_message["content"]
-            )
-            db.add(user_msg)
-            
-            # Store assistant response
-            assistant_msg = ChatMessageModel(
-                session_id=session_id,
-                role="assistant",
-                content=assistant_response,
-                tokens_used=tokens_used,
-                response_time=response_time,
-                model_used=model_used or settings.DEFAULT_MODEL
-            )
-            db.add(assistant_msg)
-            
-            await db.commit()
-        except Exception as e:
-            logger.error("Failed to store messages", error=str(e))
-            await db.rollback()
+            async with self._client.stream("POST", "/chat/completions", content=orjson.dumps(payload)) as response:
+                if response.is_error:
+                    await response.aread()
+                    raise self._api_error(response, session_id, time.perf_counter() - start_time)
+                
+                # Lines that aren't "data: " are SSE comments (keep-alive) and are skipped
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: "):
+                        continue
+                    data = line[6:]
+                    if data == "[DONE]":
+                        break
+                    
+                    chunk = orjson.loads(data)
+                    if chunk.get("error"):
+                        raise self._stream_error(chunk["error"], session_id, time.perf_counter() - start_time)
+                    usage_info = chunk.get("usage")
+                    if usage_info:
+                        tokens_used = usage_info.get("total_tokens", 0)
+                    choices = chunk.get("choices")
+                    if choices:
+                        delta = choices[0].get("delta", {}).get("content")
+                        if delta:
+                            parts.append(delta)
+                            yield delta
+        
+        except httpx.RequestError as e:
+            error_msg = f"Request error: {str(e)}"
+            record_usage(session_id, "chat", 0, time.perf_counter() - start_time, "request_error", error_msg)
+            logger.error("Request error", session_id=session_id, error=error_msg)
+            raise ProviderError(error_msg, kind="request") from e
+        
+        except orjson.JSONDecodeError as e:
+            error_msg = f"Invalid response: {str(e)}"
+            record_usage(session_id, "chat", 0, time.perf_counter() - start_time, "error", error_msg)
+            logger.error("Invalid response", session_id=session_id, error=error_msg)
+            raise ProviderError(error_msg, kind="response") from e
+        
+        response_time = time.perf_counter() - start_time
+        assistant_response = "".join(parts)
+        
+        if use_cache:
+            cache.store_chat_response(cache_key, assistant_response)
+        
+        logger.debug(
+            "Chat completion streamed",
+            session_id=session_id,
+            model=openrouter_model,
+            tokens_used=tokens_used,
+            response_time=response_time
+        )
+        
+        summary.update(
+            response=assistant_response,
+            status="success",
+            tokens_used=tokens_used,
+            response_time=response_time,
+            model_used=selected_model
+        )
 
 openrouter_service = OpenRouterService()
\ No newline at end of file
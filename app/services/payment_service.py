@@ -1,60 +1,186 @@
 """UPI Payment service using Razorpay integration."""
 
+import asyncio
+import time
 import uuid
+from functools import lru_cache
+from cachetools import TTLCache
 import razorpay
+from requests.adapters import HTTPAdapter
 import hmac
 import hashlib
-from datetime import datetime
-from typing import Dict, Any, Optional
-from urllib.parse import quote
+import re
+from datetime import timedelta
+from typing import Dict, Any, List, Optional
+from urllib.parse import quote, urlencode
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, exists
+from sqlalchemy import update, select, or_, and_, func, null, bindparam, String
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 from ..core.config import settings
+from ..core.cache import cache
 from ..models.payment import (
-    PaymentTransaction, VPAValidationResponse, CollectResponse, 
-    PaymentStatusResponse, CollectRequest
+    PaymentTransaction, ProcessedWebhookEvent, VPAValidationResponse, CollectResponse, 
+    PaymentStatusResponse, CollectRequest, to_paise
 )
 import structlog
 
 logger = structlog.get_logger()
 
+ORDER_NOTES_TTL = 86400  # Order notes are immutable after creation
+
+# Keyword classes for Razorpay SDK errors (authentication is checked first)
+GATEWAY_AUTH_PATTERN = re.compile(r"authentication|unauthorized", re.IGNORECASE)
+GATEWAY_INVALID_PATTERN = re.compile(r"bad request|invalid", re.IGNORECASE)
+
+# VPA validation results per VPA; short TTL since a VPA can be activated or deactivated
+_VPA_CACHE = TTLCache(maxsize=2048, ttl=300)
+
+# Webhook status transitions, built once and executed with bound parameters.
+# Worker sessions hold no PaymentTransaction instances, so there is nothing to synchronize.
+_UPDATE_BY_ORDER = (
+    update(PaymentTransaction)
+    .where(PaymentTransaction.order_id == bindparam("oid"))
+    .execution_options(synchronize_session=False)
+)
+_MARK_CAPTURED = _UPDATE_BY_ORDER.values(
+    status="completed", payment_id=bindparam("pid"), updated_at=func.now()
+).returning(PaymentTransaction.tracking_id)
+_MARK_FAILED = _UPDATE_BY_ORDER.values(
+    status="failed", payment_id=bindparam("pid"), error_message=bindparam("err"), updated_at=func.now()
+).returning(PaymentTransaction.tracking_id)
+_MARK_AUTHORIZED = _UPDATE_BY_ORDER.values(
+    status="authorized", payment_id=bindparam("pid"), updated_at=func.now()
+).returning(PaymentTransaction.tracking_id)
+_MARK_PAID = _UPDATE_BY_ORDER.values(
+    status="paid", updated_at=func.now()
+).returning(PaymentTransaction.tracking_id)
+# A new Payment Link has no order yet, so collect payments are correlated by link id;
+# the order id is recorded here so later order/payment events match too
+_MARK_LINK_PAID = (
+    update(PaymentTransaction)
+    .where(PaymentTransaction.payment_link_id == bindparam("lid"))
+    .values(
+        status="completed",
+        order_id=func.coalesce(bindparam("oid", type_=String), PaymentTransaction.order_id),
+        payment_id=func.coalesce(bindparam("pid", type_=String), PaymentTransaction.payment_id),
+        updated_at=func.now()
+    )
+    .execution_options(synchronize_session=False)
+    .returning(PaymentTransaction.tracking_id)
+)
+
+# Stored webhook events: a claim older than the lease belongs to a worker that died
+WEBHOOK_CLAIM_LEASE = timedelta(minutes=5)
+# Pending events younger than this are still with the worker the route handed them to
+WEBHOOK_SWEEP_AGE = timedelta(seconds=30)
+
+_WEBHOOK_CLAIMABLE = or_(
+    ProcessedWebhookEvent.status == "pending",
+    and_(
+        ProcessedWebhookEvent.status == "processing",
+        ProcessedWebhookEvent.claimed_at < func.now() - WEBHOOK_CLAIM_LEASE
+    )
+)
+_CLAIM_WEBHOOK_EVENT = (
+    update(ProcessedWebhookEvent)
+    .where(ProcessedWebhookEvent.event_id == bindparam("eid"), _WEBHOOK_CLAIMABLE)
+    .values(status="processing", claimed_at=func.now())
+    .execution_options(synchronize_session=False)
+    .returning(ProcessedWebhookEvent.payload)
+)
+_FINISH_WEBHOOK_EVENT = (
+    update(ProcessedWebhookEvent)
+    .where(ProcessedWebhookEvent.event_id == bindparam("eid"))
+    .values(status="processed", payload=null(), processed_at=func.now())
+    .execution_options(synchronize_session=False)
+)
+_RELEASE_WEBHOOK_EVENT = (
+    update(ProcessedWebhookEvent)
+    .where(ProcessedWebhookEvent.event_id == bindparam("eid"))
+    .values(status="pending", claimed_at=None)
+    .execution_options(synchronize_session=False)
+)
+_UNFINISHED_WEBHOOK_EVENTS = (
+    select(ProcessedWebhookEvent.event_id)
+    .where(
+        ProcessedWebhookEvent.status != "processed",
+        ProcessedWebhookEvent.received_at < func.now() - WEBHOOK_SWEEP_AGE,
+        _WEBHOOK_CLAIMABLE
+    )
+    .order_by(ProcessedWebhookEvent.received_at)
+    .limit(bindparam("limit"))
+)
+
+# Keyed HMAC state built once; each webhook verifies on a copy
+_WEBHOOK_HMAC = hmac.new(settings.RAZORPAY_WEBHOOK_SECRET.encode('utf-8'), digestmod=hashlib.sha256)
+
+
+@lru_cache(maxsize=1)
+def _get_razorpay_client() -> razorpay.Client:
+    """Process-wide Razorpay client, so its requests.Session keeps connections alive across calls."""
+    client = razorpay.Client(
+        auth=(settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_SECRET)
+    )
+    client.set_app_details({
+        "title": settings.PROJECT_NAME, 
+        "version": settings.API_VERSION
+    })
+    # SDK calls run in worker threads; a larger pool keeps concurrent calls from queueing on one connection
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=50)
+    client.session.mount("https://", adapter)
+    return client
+
 
 class PaymentService:
     """Service class for handling UPI payments."""
     
+    DEFAULT_MOBILE = "9987582423"  # Default mobile for SMS notifications
+    
+    # Webhook event -> (payload entity key, handler method); None passes the whole payload
+    _WEBHOOK_HANDLERS = {
+        "payment_link.paid": (None, "_handle_payment_link_paid"),
+        "payment.captured": ("payment", "_handle_payment_captured"),
+        "payment.failed": ("payment", "_handle_payment_failed"),
+        "payment.authorized": ("payment", "_handle_payment_authorized"),
+        "order.paid": ("order", "_handle_order_paid"),
+        "refund.created": ("refund", "_handle_refund_created"),
+        "refund.processed": ("refund", "_handle_refund_processed"),
+    }
+    
     def __init__(self):
         """Initialize Razorpay client."""
-        self.razorpay_client = razorpay.Client(
-            auth=(settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_SECRET)
-        )
-        self.razorpay_client.set_app_details({
-            "title": settings.PROJECT_NAME, 
-            "version": settings.API_VERSION
-        })
-        self.default_mobile = "9987582423"  # Default mobile for SMS notifications
+        self.razorpay_client = _get_razorpay_client()
 
     async def validate_vpa(self, vpa: str) -> VPAValidationResponse:
         """Validate UPI VPA format and structure."""
+        cached = _VPA_CACHE.get(vpa)
+        if cached is not None:
+            return cached
+        
         try:
             logger.info("Validating VPA", vpa=vpa)
             
             # Basic format validation (already done by Pydantic)
-            if "@" not in vpa or len(vpa.split("@")) != 2:
-                return VPAValidationResponse(
+            if vpa.count("@") != 1 or vpa.startswith("@") or vpa.endswith("@"):
+                result = VPAValidationResponse(
                     valid=False,
                     vpa=vpa,
                     error="Invalid VPA format"
                 )
+            else:
+                # In production, you might want to use Razorpay VPA validation API
+                # For now, we'll do basic validation
+                logger.info("VPA validated successfully", vpa=vpa)
+                result = VPAValidationResponse(
+                    valid=True,
+                    vpa=vpa,
+                    account_holder_name="Account Holder"
+                )
             
-            # In production, you might want to use Razorpay VPA validation API
-            # For now, we'll do basic validation
-            logger.info("VPA validated successfully", vpa=vpa)
-            return VPAValidationResponse(
-                valid=True,
-                vpa=vpa,
-                account_holder_name="Account Holder"
-            )
+            # Errors (below) are not cached
+            _VPA_CACHE[vpa] = result
+            return result
             
         except Exception as e:
             logger.error("VPA validation error", vpa=vpa, error=str(e))
@@ -88,19 +214,19 @@ class PaymentService:
             UPI intent URL string
         """
         try:
-            # URL encode parameters to handle special characters
-            params = [
-                f"pa={quote(payee_vpa)}",  # Payee address (mandatory)
-                f"pn={quote(payee_name)}",  # Payee name (mandatory)
-                f"tr={quote(transaction_reference)}",  # Transaction reference (mandatory for merchants)
-                f"am={amount}",  # Amount 
-                "cu=INR",  # Currency (INR for India)
-                f"tn={quote(transaction_note)}"  # Transaction note
-            ]
-            
-            upi_url = f"upi://pay?{'&'.join(params)}"
-            
-            logger.info(
+            # URL encode parameters to handle special characters (one pass, quote() escaping as before)
+            query = urlencode({
+                "pa": payee_vpa,  # Payee address (mandatory)
+                "pn": payee_name,  # Payee name (mandatory)
+                "tr": transaction_reference,  # Transaction reference (mandatory for merchants)
+                "am": amount,  # Amount 
+                "cu": "INR",  # Currency (INR for India)
+                "tn": transaction_note  # Transaction note
+            }, safe="/", quote_via=quote)
+            
+            upi_url = f"upi://pay?{query}"
+            
+            logger.debug(
                 "UPI intent URL generated", 
                 payee_vpa=payee_vpa, 
                 amount=amount,
@@ -119,6 +245,7 @@ class PaymentService:
         db: AsyncSession
     ) -> CollectResponse:
         """Create UPI payment request using Razorpay Payment Links."""
+        start_time = time.perf_counter()
         try:
             logger.info(
                 "Creating payment request", 
@@ -126,36 +253,19 @@ class PaymentService:
                 amount=request.amount
             )
             
-            # Generate unique identifiers
+            # Generate unique identifier
             tracking_id = f"track_{uuid.uuid4().hex[:8]}"
-            receipt_id = f"receipt_{uuid.uuid4().hex[:12]}"
-            
-            # Step 1: Create Razorpay order
-            order_data = {
-                "amount": int(request.amount * 100),  # Convert to paise
-                "currency": "INR",
-                "receipt": receipt_id,
-                "notes": {
-                    "payer_vpa": request.payer_vpa,
-                    "beneficiary_vpa": request.beneficiary_vpa,
-                    "beneficiary_name": request.beneficiary_name,
-                    "description": request.description,
-                    "tracking_id": tracking_id
-                }
-            }
             
-            logger.info("Creating Razorpay order", amount=request.amount)
-            order = self.razorpay_client.order.create(order_data)
-            logger.info("Order created successfully", order_id=order['id'])
-            
-            # Step 2: Create Payment Link with UPI-only checkout
+            # Step 1: Create Payment Link with UPI-only checkout.
+            # Razorpay creates the link's order itself, so no separate order.create round trip.
             payment_link_data = {
-                "amount": int(request.amount * 100),  # Amount in paise
+                "amount": to_paise(request.amount),  # Amount in paise
                 "currency": "INR", 
+                "reference_id": tracking_id,  # Merchant-side reference, unique per link
                 "description": request.description,
                 "customer": {
                     "name": request.beneficiary_name,
-                    "contact": self.default_mobile,
+                    "contact": self.DEFAULT_MOBILE,
                     "email": "payer@example.com",  # Optional
                 },
                 "notify": {
@@ -180,11 +290,14 @@ class PaymentService:
                 }
             }
             
-            logger.info("Creating UPI payment link", payer_vpa=request.payer_vpa)
-            payment_link = self.razorpay_client.payment_link.create(payment_link_data)
-            logger.info("UPI payment link created", payment_link_id=payment_link['id'])
+            logger.debug("Creating UPI payment link", payer_vpa=request.payer_vpa)
+            # The Razorpay SDK is blocking (requests); calls go through a worker thread
+            payment_link = await asyncio.to_thread(self.razorpay_client.payment_link.create, payment_link_data)
+            # Usually None until the link is paid; payment_link.paid fills it in
+            order_id = payment_link.get("order_id") or None
+            logger.debug("UPI payment link created", payment_link_id=payment_link['id'], order_id=order_id)
             
-            # Step 3: Generate UPI intent URL for direct app invocation
+            # Step 2: Generate UPI intent URL for direct app invocation
             upi_intent_url = self.generate_upi_intent_url(
                 payee_vpa=request.beneficiary_vpa,
                 payee_name=request.beneficiary_name,
@@ -193,10 +306,10 @@ class PaymentService:
                 transaction_note=request.description
             )
             
-            # Step 4: Store payment record in database
+            # Step 3: Store payment record in database
             payment_record = PaymentTransaction(
                 tracking_id=tracking_id,
-                order_id=order["id"],
+                order_id=order_id,
                 payment_link_id=payment_link["id"],
                 payment_link_url=payment_link.get("short_url", ""),
                 upi_intent_url=upi_intent_url,
@@ -205,20 +318,24 @@ class PaymentService:
                 beneficiary_vpa=request.beneficiary_vpa,
                 beneficiary_name=request.beneficiary_name,
                 description=request.description,
-                status=payment_link.get("status", "created"),
-                created_at=datetime.utcnow(),
-                updated_at=datetime.utcnow()
+                status=payment_link.get("status", "created")
             )
             
             db.add(payment_record)
             await db.commit()
             
-            logger.info("Payment record saved", tracking_id=tracking_id)
+            logger.info(
+                "Payment record saved",
+                tracking_id=tracking_id,
+                order_id=order_id,
+                payment_link_id=payment_link["id"],
+                duration_ms=round((time.perf_counter() - start_time) * 1000, 1)
+            )
             
             return CollectResponse(
                 success=True,
                 payment_id=payment_link["id"],
-                order_id=order["id"],
+                order_id=order_id,
                 status=payment_link.get("status", "created"),
                 message=f"UPI payment request created for {request.beneficiary_name}. Use UPI intent to pay directly via your UPI app.",
                 tracking_id=tracking_id,
@@ -231,12 +348,12 @@ class PaymentService:
             logger.error("Payment request error", error=error_msg)
             
             # Check for specific error patterns
-            if "authentication" in error_msg.lower() or "unauthorized" in error_msg.lower():
+            if GATEWAY_AUTH_PATTERN.search(error_msg):
                 return CollectResponse(
                     success=False,
                     message="Payment gateway authentication failed. Please check configuration."
                 )
-            elif "bad request" in error_msg.lower() or "invalid" in error_msg.lower():
+            elif GATEWAY_INVALID_PATTERN.search(error_msg):
                 return CollectResponse(
                     success=False,
                     message=f"Invalid payment request: {error_msg}"
@@ -254,13 +371,8 @@ class PaymentService:
     ) -> Optional[PaymentStatusResponse]:
         """Get payment status by tracking ID."""
         try:
-            # Query payment record from database
-            result = await db.execute(
-                select(PaymentTransaction).where(
-                    PaymentTransaction.tracking_id == tracking_id
-                )
-            )
-            payment_record = result.scalar_one_or_none()
+            # Primary-key lookup (served from the identity map if already loaded)
+            payment_record = await db.get(PaymentTransaction, tracking_id)
             
             if not payment_record:
                 return None
@@ -285,12 +397,12 @@ class PaymentService:
             logger.error("Status check error", tracking_id=tracking_id, error=str(e))
             return None
 
-    async def verify_webhook_signature(self, body: str, signature: str) -> bool:
+    def verify_webhook_signature(self, body: bytes, signature: str) -> bool:
         """
         Verify Razorpay webhook signature using HMAC SHA256.
         
         Args:
-            body: Raw webhook request body as string
+            body: Raw webhook request body bytes
             signature: X-Razorpay-Signature header value
             
         Returns:
@@ -302,11 +414,9 @@ class PaymentService:
                 return False
             
             # Generate expected signature
-            expected_signature = hmac.new(
-                key=settings.RAZORPAY_WEBHOOK_SECRET.encode('utf-8'),
-                msg=body.encode('utf-8'),
-                digestmod=hashlib.sha256
-            ).hexdigest()
+            mac = _WEBHOOK_HMAC.copy()
+            mac.update(body)
+            expected_signature = mac.hexdigest()
             
             # Compare signatures (use hmac.compare_digest for timing attack protection)
             is_valid = hmac.compare_digest(expected_signature, signature)
@@ -322,41 +432,58 @@ class PaymentService:
             logger.error("Webhook signature verification error", error=str(e))
             return False
     
-    async def check_duplicate_event(self, event_id: str, db: AsyncSession) -> bool:
+    async def record_webhook_event(self, event_id: str, webhook_data: Dict[str, Any], db: AsyncSession) -> bool:
         """
-        Check if webhook event has already been processed (idempotency).
+        Store a verified webhook event as pending (before it is acknowledged).
+        
+        The primary key makes this atomic, so a concurrent or replayed delivery of the
+        same event gets False. The caller commits.
         
         Args:
             event_id: X-Razorpay-Event-Id header value
+            webhook_data: Parsed event body
             db: Database session
             
         Returns:
-            True if event is duplicate, False otherwise
+            True if the event is new, False if it is a duplicate
         """
-        try:
-            if not event_id:
-                return False
-            
-            # Check if event_id exists in processed_webhook_events table
-            # For simplicity, storing in payment_transaction notes field
-            result = await db.execute(
-                select(exists().where(
-                    PaymentTransaction.notes.like(f'%"event_id": "{event_id}"%')
-                ))
-            )
-            is_duplicate = result.scalar()
-            
-            return is_duplicate
-            
-        except Exception as e:
-            logger.error("Duplicate check error", error=str(e))
-            return False
+        result = await db.execute(
+            pg_insert(ProcessedWebhookEvent)
+            .values(event_id=event_id, status="pending", payload=webhook_data)
+            .on_conflict_do_nothing(index_elements=[ProcessedWebhookEvent.event_id])
+            .returning(ProcessedWebhookEvent.event_id)
+        )
+        return result.scalar_one_or_none() is not None
+    
+    async def claim_webhook_event(self, event_id: str, db: AsyncSession) -> Optional[Dict[str, Any]]:
+        """
+        Claim a stored webhook event for processing.
+        
+        Pending events, and events whose last attempt has outlived WEBHOOK_CLAIM_LEASE
+        (the process died mid-way), move to processing in one UPDATE, so only one worker
+        across all replicas gets each. The caller commits the claim before processing.
+        
+        Returns:
+            The event body, or None if the event is done or another worker holds it
+        """
+        result = await db.execute(_CLAIM_WEBHOOK_EVENT, {"eid": event_id})
+        return result.scalar_one_or_none()
+    
+    async def finish_webhook_event(self, event_id: str, succeeded: bool, db: AsyncSession):
+        """Mark a claimed event processed, or return it to pending for the next sweep. The caller commits."""
+        await db.execute(_FINISH_WEBHOOK_EVENT if succeeded else _RELEASE_WEBHOOK_EVENT, {"eid": event_id})
+    
+    async def unfinished_webhook_events(self, db: AsyncSession, limit: int = 100) -> List[str]:
+        """Ids of events a worker should (re)try: pending for a while, or with an expired claim."""
+        result = await db.execute(_UNFINISHED_WEBHOOK_EVENTS, {"limit": limit})
+        return list(result.scalars())
 
     async def process_webhook(self, webhook_data: Dict[str, Any], event_id: str, db: AsyncSession) -> bool:
         """
         Process Razorpay webhook data with enhanced event handling.
         
         Supported events:
+        - payment_link.paid: UPI collect link paid (matched by payment link id)
         - payment.captured: Payment successful
         - payment.failed: Payment failed  
         - payment.authorized: Payment authorized (for two-step payments)
@@ -370,43 +497,15 @@ class PaymentService:
             
             logger.info("Processing webhook", webhook_event=event, event_id=event_id)
             
-            # Extract entity based on event type
-            if "payment" in event:
-                entity = payload.get("payment", {}).get("entity", {})
-            elif "order" in event:
-                entity = payload.get("order", {}).get("entity", {})
-            elif "refund" in event:
-                entity = payload.get("refund", {}).get("entity", {})
-            else:
-                entity = {}
-            
-            # Handle different event types
-            if event == "payment.captured":
-                # Payment successful
-                await self._handle_payment_captured(entity, event_id, db)
-                
-            elif event == "payment.failed":
-                # Payment failed
-                await self._handle_payment_failed(entity, event_id, db)
-                
-            elif event == "payment.authorized":
-                # Payment authorized (for two-step payments)
-                await self._handle_payment_authorized(entity, event_id, db)
-                
-            elif event == "order.paid":
-                # Order fully paid
-                await self._handle_order_paid(entity, event_id, db)
-                
-            elif event == "refund.created":
-                # Refund initiated
-                await self._handle_refund_created(entity, event_id, db)
-                
-            elif event == "refund.processed":
-                # Refund completed
-                await self._handle_refund_processed(entity, event_id, db)
-                
-            else:
+            # One lookup gives both the payload entity and the handler
+            dispatch = self._WEBHOOK_HANDLERS.get(event)
+            if dispatch is None:
                 logger.info("Unhandled webhook event type", event=event)
+                return True
+            
+            entity_key, handler_name = dispatch
+            entity = payload.get(entity_key, {}).get("entity", {}) if entity_key else payload
+            await getattr(self, handler_name)(entity, event_id, db)
             
             return True
             
@@ -414,6 +513,34 @@ class PaymentService:
             logger.error("Webhook processing error", error=str(e), event_id=event_id)
             return False
     
+    async def _handle_payment_link_paid(self, payload: Dict, event_id: str, db: AsyncSession):
+        """Handle a paid UPI collect link."""
+        try:
+            link_entity = payload.get("payment_link", {}).get("entity", {})
+            payment_entity = payload.get("payment", {}).get("entity", {})
+            payment_link_id = link_entity.get("id")
+            order_id = link_entity.get("order_id") or payload.get("order", {}).get("entity", {}).get("id")
+            payment_id = payment_entity.get("id")
+            
+            result = await db.execute(
+                _MARK_LINK_PAID, {"lid": payment_link_id, "oid": order_id, "pid": payment_id}
+            )
+            tracking_id = result.scalar_one_or_none()
+            
+            if tracking_id:
+                await db.commit()
+                logger.info("Payment link paid", 
+                    tracking_id=tracking_id,
+                    payment_link_id=payment_link_id,
+                    payment_id=payment_id)
+            else:
+                logger.warning("Payment record not found for paid link", payment_link_id=payment_link_id)
+                
+        except Exception as e:
+            logger.error("Error handling payment link paid", error=str(e))
+            await db.rollback()
+            raise  # the event stays pending and is retried
+    
     async def _handle_payment_captured(self, payment_entity: Dict, event_id: str, db: AsyncSession):
         """Handle successful payment capture."""
         try:
@@ -421,27 +548,14 @@ class PaymentService:
             payment_id = payment_entity.get("id")
             amount = payment_entity.get("amount", 0) / 100  # Convert from paise
             
-            # Update payment record
-            result = await db.execute(
-                select(PaymentTransaction).where(
-                    PaymentTransaction.order_id == order_id
-                )
-            )
-            payment_record = result.scalar_one_or_none()
-            
-            if payment_record:
-                payment_record.status = "completed"
-                payment_record.payment_id = payment_id
-                payment_record.updated_at = datetime.utcnow()
-                # Store event_id to prevent duplicate processing
-                if payment_record.notes:
-                    payment_record.notes += f', "event_id": "{event_id}"'
-                else:
-                    payment_record.notes = f'{{"event_id": "{event_id}"}}'
-                    
+            # Update payment record in one round trip
+            result = await db.execute(_MARK_CAPTURED, {"oid": order_id, "pid": payment_id})
+            tracking_id = result.scalar_one_or_none()
+            
+            if tracking_id:
                 await db.commit()
                 logger.info("Payment captured", 
-                    tracking_id=payment_record.tracking_id,
+                    tracking_id=tracking_id,
                     payment_id=payment_id,
                     amount=amount)
             else:
@@ -450,6 +564,7 @@ class PaymentService:
         except Exception as e:
             logger.error("Error handling payment captured", error=str(e))
             await db.rollback()
+            raise  # the event stays pending and is retried
     
     async def _handle_payment_failed(self, payment_entity: Dict, event_id: str, db: AsyncSession):
         """Handle failed payment."""
@@ -459,31 +574,20 @@ class PaymentService:
             error_description = payment_entity.get("error_description", "Unknown error")
             
             result = await db.execute(
-                select(PaymentTransaction).where(
-                    PaymentTransaction.order_id == order_id
-                )
+                _MARK_FAILED, {"oid": order_id, "pid": payment_id, "err": error_description}
             )
-            payment_record = result.scalar_one_or_none()
-            
-            if payment_record:
-                payment_record.status = "failed"
-                payment_record.payment_id = payment_id
-                payment_record.error_message = error_description
-                payment_record.updated_at = datetime.utcnow()
-                # Store event_id
-                if payment_record.notes:
-                    payment_record.notes += f', "event_id": "{event_id}"'
-                else:
-                    payment_record.notes = f'{{"event_id": "{event_id}"}}'
-                    
+            tracking_id = result.scalar_one_or_none()
+            
+            if tracking_id:
                 await db.commit()
                 logger.info("Payment failed", 
-                    tracking_id=payment_record.tracking_id,
+                    tracking_id=tracking_id,
                     error=error_description)
             
         except Exception as e:
             logger.error("Error handling payment failed", error=str(e))
             await db.rollback()
+            raise  # the event stays pending and is retried
     
     async def _handle_payment_authorized(self, payment_entity: Dict, event_id: str, db: AsyncSession):
         """Handle payment authorization (for two-step payments)."""
@@ -491,23 +595,17 @@ class PaymentService:
             order_id = payment_entity.get("order_id")
             payment_id = payment_entity.get("id")
             
-            result = await db.execute(
-                select(PaymentTransaction).where(
-                    PaymentTransaction.order_id == order_id
-                )
-            )
-            payment_record = result.scalar_one_or_none()
+            result = await db.execute(_MARK_AUTHORIZED, {"oid": order_id, "pid": payment_id})
+            tracking_id = result.scalar_one_or_none()
             
-            if payment_record:
-                payment_record.status = "authorized"
-                payment_record.payment_id = payment_id
-                payment_record.updated_at = datetime.utcnow()
+            if tracking_id:
                 await db.commit()
-                logger.info("Payment authorized", tracking_id=payment_record.tracking_id)
+                logger.info("Payment authorized", tracking_id=tracking_id)
                 
         except Exception as e:
             logger.error("Error handling payment authorized", error=str(e))
             await db.rollback()
+            raise  # the event stays pending and is retried
     
     async def _handle_order_paid(self, order_entity: Dict, event_id: str, db: AsyncSession):
         """Handle order paid event."""
@@ -515,22 +613,17 @@ class PaymentService:
             order_id = order_entity.get("id")
             amount = order_entity.get("amount_paid", 0) / 100
             
-            result = await db.execute(
-                select(PaymentTransaction).where(
-                    PaymentTransaction.order_id == order_id
-                )
-            )
-            payment_record = result.scalar_one_or_none()
+            result = await db.execute(_MARK_PAID, {"oid": order_id})
+            tracking_id = result.scalar_one_or_none()
             
-            if payment_record:
-                payment_record.status = "paid"
-                payment_record.updated_at = datetime.utcnow()
+            if tracking_id:
                 await db.commit()
-                logger.info("Order paid", tracking_id=payment_record.tracking_id, amount=amount)
+                logger.info("Order paid", tracking_id=tracking_id, amount=amount)
                 
         except Exception as e:
             logger.error("Error handling order paid", error=str(e))
             await db.rollback()
+            raise  # the event stays pending and is retried
     
     async def _handle_refund_created(self, refund_entity: Dict, event_id: str, db: AsyncSession):
         """Handle refund created event."""
@@ -564,6 +657,19 @@ class PaymentService:
         except Exception as e:
             logger.error("Error handling refund processed", error=str(e))
 
+    async def fetch_order_notes(self, order_id: str) -> Dict[str, Any]:
+        """Get order notes, cached in Redis since they never change after creation."""
+        cache_key = f"rzp:order:{order_id}:notes"
+        order_notes = await cache.get_json(cache_key)
+        if order_notes is not None:
+            return order_notes
+        
+        # Razorpay SDK is blocking; keep it off the event loop
+        order_details = await asyncio.to_thread(self.razorpay_client.order.fetch, order_id)
+        order_notes = order_details.get("notes", {})
+        await cache.set_json(cache_key, order_notes, ORDER_NOTES_TTL)
+        return order_notes
+
     async def create_razorpay_order(self, amount: float, notes: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """Create Razorpay order for in-app payment."""
         try:
@@ -574,7 +680,7 @@ class PaymentService:
             
             # Create order data
             order_data = {
-                "amount": int(amount * 100),  # Convert to paise
+                "amount": to_paise(amount),  # Convert to paise
                 "currency": "INR",
                 "receipt": receipt_id,
                 "notes": notes or {
@@ -583,8 +689,8 @@ class PaymentService:
                 }
             }
             
-            # Create Razorpay order
-            order = self.razorpay_client.order.create(order_data)
+            # Create Razorpay order (blocking SDK call, run in a worker thread)
+            order = await asyncio.to_thread(self.razorpay_client.order.create, order_data)
             logger.info("Razorpay order created", order_id=order['id'])
             
             return {
@@ -618,9 +724,12 @@ class PaymentService:
         try:
             logger.info("Verifying payment status", payment_id=payment_id, order_id=order_id)
             
-            # Fetch payment details from Razorpay
-            payment_details = self.razorpay_client.payment.fetch(payment_id)
-            order_details = self.razorpay_client.order.fetch(order_id)
+            # Payment and order lookups are independent; run them concurrently.
+            # Only the order's notes are used, and those are cached (immutable after creation).
+            payment_details, order_notes = await asyncio.gather(
+                asyncio.to_thread(self.razorpay_client.payment.fetch, payment_id),
+                self.fetch_order_notes(order_id)
+            )
             
             payment_status = payment_details.get('status', 'unknown')
             payment_method = payment_details.get('method', 'unknown')
@@ -648,7 +757,7 @@ class PaymentService:
                 "is_successful": is_successful,
                 "captured_at": payment_details.get('captured_at'),
                 "created_at": payment_details.get('created_at'),
-                "order_notes": order_details.get('notes', {}),
+                "order_notes": order_notes,
                 "payment_details": {
                     "bank": payment_details.get('bank', ''),
                     "wallet": payment_details.get('wallet', ''),
@@ -0,0 +1,91 @@
+"""
+Batched api_usage writer
+Usage rows are never read on the request path, so they are queued and written as
+one multi-row INSERT per FLUSH_INTERVAL instead of costing each request a commit.
+"""
+import asyncio
+from typing import Dict, List, Optional
+from sqlalchemy import insert
+import structlog
+
+from ..core.database import AsyncSessionLocal
+from ..models.chat import ApiUsage
+
+logger = structlog.get_logger()
+
+FLUSH_INTERVAL = 0.05  # seconds
+MAX_BATCH = 1000
+
+usage_queue: "asyncio.Queue[Dict]" = asyncio.Queue(maxsize=10_000)
+_writer_task: Optional[asyncio.Task] = None
+
+
+def record_usage(
+    session_id: str,
+    endpoint: str,
+    tokens_used: int,
+    response_time: float,
+    status: str,
+    error_message: Optional[str] = None
+) -> None:
+    """Queue an api_usage row for the next flush (dropped if the writer is backed up)"""
+    try:
+        # Same keys on every row so a batch goes out as one INSERT ... VALUES (...), (...)
+        usage_queue.put_nowait({
+            "session_id": session_id,
+            "endpoint": endpoint,
+            "tokens_used": tokens_used,
+            "response_time": response_time,
+            "success": status,
+            "error_message": error_message
+        })
+    except asyncio.QueueFull:
+        logger.warning("Usage queue full, dropping row", session_id=session_id, status=status)
+
+
+def _drain() -> List[Dict]:
+    rows = []
+    while len(rows) < MAX_BATCH:
+        try:
+            rows.append(usage_queue.get_nowait())
+        except asyncio.QueueEmpty:
+            break
+    return rows
+
+
+async def flush() -> None:
+    """Write everything queued so far"""
+    rows = _drain()
+    while rows:
+        async with AsyncSessionLocal() as db:
+            await db.execute(insert(ApiUsage), rows)
+            await db.commit()
+        rows = _drain()
+
+
+async def _writer_loop():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        try:
+            await flush()
+        except Exception as e:
+            logger.error("Failed to write usage rows", error=str(e))
+
+
+def start_usage_writer():
+    """Spawn the usage writer task (called on app startup)."""
+    global _writer_task
+    _writer_task = asyncio.create_task(_writer_loop())
+
+
+async def stop_usage_writer():
+    """Stop the writer and flush what is left (called on app shutdown)."""
+    global _writer_task
+    if _writer_task is not None:
+        _writer_task.cancel()
+        await asyncio.gather(_writer_task, return_exceptions=True)
+        _writer_task = None
+    try:
+        await flush()
+    except Exception as e:
+        logger.error("Failed to write usage rows", error=str(e))
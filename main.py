@@ -5,4 +5,6 @@ from app.main import app
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # "auto" runs on uvloop where it is installed (everywhere but Windows), the same
+    # loop the gunicorn UvicornWorker picks in Docker
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="auto")
\ No newline at end of file
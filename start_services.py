@@ -1,150 +1,206 @@
 #!/usr/bin/env python3
 
+import asyncio
+import logging
 import os
 import sys
-import subprocess
 import time
-import threading
 from pathlib import Path
 import signal
 
+log = logging.getLogger("svc")
+
+# IPv4 loopback literal: no name lookup, and no ::1 attempt when uvicorn is bound to 0.0.0.0
+HEALTH_URL = "http://127.0.0.1:8000/api/v1/health"
+
 class ServiceManager:
-    def __init__(self):
+    def __init__(self, dev=False):
         self.processes = []
-        self.running = True
-        
-    def start_backend(self):
+        self.dev = dev  # auto-reload on source changes, for local development
+        # Optional Unix socket path; when set, the backend listens there instead of on TCP :8000
+        self.uds = os.environ.get("BACKEND_UDS") or None
+        # Set by SIGINT/SIGTERM; everything that waits also wakes on this
+        self._stop_event = asyncio.Event()
+    
+    def stop(self):
+        self._stop_event.set()
+    
+    async def start_backend(self):
         """Start the FastAPI backend"""
-        print("Starting FastAPI backend...")
+        log.info("Starting FastAPI backend...")
         cmd = [
             sys.executable, "-m", "uvicorn", 
-            "app.main:app", 
-            "--host", "0.0.0.0", 
-            "--port", "8000",
-            "--reload"
+            "app.main:app"
         ]
+        if self.uds:
+            cmd += ["--uds", self.uds]
+        else:
+            cmd += ["--host", "0.0.0.0", "--port", "8000"]
+        if self.dev:
+            cmd += ["--reload"]
+        else:
+            # No file watcher; C event loop and HTTP parser, one worker per core as in Docker
+            cmd += [
+                "--loop", "uvloop" if sys.platform != "win32" else "asyncio",
+                "--http", "httptools",
+                "--no-access-log",
+                "--workers", str(os.cpu_count() or 1)
+            ]
         
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            bufsize=1
-        )
+        # The child inherits our stdout/stderr, so its logs go straight to the terminal
+        # without a forwarding thread in this process
+        process = await asyncio.create_subprocess_exec(*cmd)
         
         self.processes.append(("Backend", process))
         
-        # Monitor backend output in a thread
-        def monitor_backend():
-            for line in iter(process.stdout.readline, ''):
-                if self.running:
-                    print(f"[Backend] {line.rstrip()}")
-                else:
-                    break
-        
-        thread = threading.Thread(target=monitor_backend, daemon=True)
-        thread.start()
-        
         return process
     
-    def wait_for_backend(self, timeout=30):
+    async def wait_for_backend(self, timeout=30):
         """Wait for backend to be ready"""
         import httpx
         
-        print("Waiting for backend to be ready...")
+        log.info("Waiting for backend to be ready...")
         
-        for i in range(timeout):
-            try:
-                with httpx.Client(timeout=2.0) as client:
-                    response = client.get("http://localhost:8000/api/v1/health")
+        start = time.monotonic()
+        deadline = start + timeout
+        next_report = start + 5
+        delay = 0.025
+        last_err = None
+        # One client for all probes so they reuse a keep-alive connection once the server is up
+        transport = httpx.AsyncHTTPTransport(uds=self.uds) if self.uds else None
+        async with httpx.AsyncClient(timeout=1.0, transport=transport) as client:
+            while not self._stop_event.is_set() and time.monotonic() < deadline:
+                try:
+                    response = await client.get(HEALTH_URL)
                     if response.status_code == 200:
-                        print("Backend is ready!")
+                        log.info("Backend is ready!")
                         return True
-            except:
-                pass
-            
-            time.sleep(1)
-            if i % 5 == 0:
-                print(f"  Still waiting... ({i}/{timeout}s)")
+                except httpx.TransportError as e:
+                    last_err = e
+                
+                # Back off from 25 ms up to 500 ms between probes; a stop signal cuts the wait short
+                try:
+                    await asyncio.wait_for(self._stop_event.wait(), delay)
+                except TimeoutError:
+                    pass
+                delay = min(delay * 1.7, 0.5)
+                if time.monotonic() >= next_report:
+                    log.debug("  Still waiting... (%d/%ds)", time.monotonic() - start, timeout)
+                    next_report += 5
         
-        print("Backend failed to start within timeout")
+        if not self._stop_event.is_set():
+            log.error("Backend failed to start within timeout")
+            if last_err is not None:
+                log.error("  Last probe error: %r", last_err)
         return False
     
-    def stop_all(self):
+    async def wait_for_exit(self):
+        """Wait until a child exits (returns its name) or a stop signal arrives (returns None)"""
+        exits = {asyncio.ensure_future(process.wait()): name for name, process in self.processes}
+        stop = asyncio.ensure_future(self._stop_event.wait())
+        try:
+            done, _ = await asyncio.wait({stop, *exits}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (stop, *exits):
+                task.cancel()
+        
+        for task in done:
+            if task in exits:
+                return exits[task]
+        return None
+    
+    async def stop_all(self):
         """Stop all services"""
-        print("\nStopping backend service...")
-        self.running = False
+        running = [(name, process) for name, process in self.processes if process.returncode is None]
+        if not running:
+            return
+        log.info("\nStopping backend service...")
         
-        for name, process in self.processes:
+        # Signal every child first, then give them one shared 5 s grace period
+        for name, process in running:
             try:
-                print(f"  Stopping {name}...")
                 process.terminate()
-                process.wait(timeout=5)
-                print(f"  {name} stopped")
-            except subprocess.TimeoutExpired:
-                print(f"  Force killing {name}...")
+            except ProcessLookupError:
+                pass  # exited in the meantime
+        
+        _, pending = await asyncio.wait([asyncio.ensure_future(process.wait()) for _, process in running], timeout=5)
+        killed = [name for name, process in running if process.returncode is None]
+        for name, process in running:
+            if process.returncode is None:
                 process.kill()
-                process.wait()
-            except Exception as e:
-                print(f"  Error stopping {name}: {e}")
+        if pending:
+            await asyncio.wait(pending)
+        if self.uds:
+            try:
+                os.unlink(self.uds)
+            except FileNotFoundError:
+                pass
+        
+        if killed:
+            log.warning("  Force killed: %s", ", ".join(killed))
+        else:
+            log.info("  All services stopped")
+    
+    def _install_signal_handlers(self):
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, self.stop)
+            except NotImplementedError:
+                # Windows event loops have no add_signal_handler; the plain handler
+                # hands the stop over to the loop instead
+                signal.signal(signum, lambda *_: loop.call_soon_threadsafe(self.stop))
     
-    def run(self):
+    async def run(self):
         """Run backend service"""
+        self._install_signal_handlers()
         try:
             # Start backend
-            backend_process = self.start_backend()
+            await self.start_backend()
             
             # Wait for backend to be ready
-            if not self.wait_for_backend():
-                return 1
+            if not await self.wait_for_backend():
+                return 0 if self._stop_event.is_set() else 1
             
-            print("\n" + "=" * 60)
-            print("Backend service started successfully!")
-            print("Backend API: http://localhost:8000")
-            print("API Docs: http://localhost:8000/docs")
-            print("Health Check: http://localhost:8000/api/v1/health")
-            print("=" * 60)
-            print("\nPress Ctrl+C to stop the service\n")
+            log.info("\n" + "=" * 60)
+            log.info("Backend service started successfully!")
+            if self.uds:
+                log.info("Backend socket: %s", self.uds)
+                log.info("Health Check: curl --unix-socket %s http://localhost/api/v1/health", self.uds)
+            else:
+                log.info("Backend API: http://localhost:8000")
+                log.info("API Docs: http://localhost:8000/docs")
+                log.info("Health Check: http://localhost:8000/api/v1/health")
+            log.info("=" * 60)
+            log.info("\nPress Ctrl+C to stop the service\n")
             
             # Wait for process
-            try:
-                while self.running:
-                    # Check if process died
-                    for name, process in self.processes:
-                        if process.poll() is not None:
-                            print(f"{name} process died unexpectedly")
-                            return 1
-                    
-                    time.sleep(1)
-                    
-            except KeyboardInterrupt:
-                print("\nReceived interrupt signal")
-                
-            return 0
+            dead = await self.wait_for_exit()
+            if dead is not None:
+                log.error("%s process died unexpectedly", dead)
+                return 1
             
+            log.info("\nReceived interrupt signal")
+            return 0
+        
         except Exception as e:
-            print(f"Error running backend service: {e}")
+            log.error("Error running backend service: %s", e)
             return 1
         finally:
-            self.stop_all()
+            await self.stop_all()
 
 def main():
     """Main entry point"""
+    # Status lines only; SVC_LOG=DEBUG adds startup progress
+    logging.basicConfig(level=os.environ.get("SVC_LOG", "INFO"), format="%(message)s", stream=sys.stdout)
+    
     # Check if we're in the right directory
     if not Path("app").exists():
-        print("Please run this script from the chat-backend directory")
+        log.error("Please run this script from the chat-backend directory")
         return 1
     
-    # Set up signal handlers
-    manager = ServiceManager()
-    
-    def signal_handler(signum, frame):
-        manager.running = False
-    
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-    
-    return manager.run()
+    manager = ServiceManager(dev="--dev" in sys.argv[1:] or os.environ.get("DEV") == "1")
+    return asyncio.run(manager.run())
 
 if __name__ == "__main__":
-    sys.exit(main())
\ No newline at end of file
+    sys.exit(main())